@@ -0,0 +1,83 @@
+import download_cache
+import hashlib
+import json
+from logging_setup import logging
+import metrics
+import os
+import sqlite3
+import threading
+import time
+
+def contentHash(content):
+    if isinstance(content, str):
+        content = content.encode('utf8')
+    return hashlib.sha256(content).hexdigest()
+
+class ArtifactCache:
+    # Results derived from a download (extracted text, parsed rows), keyed by the hash of
+    # the content they came from. Each kind carries the version of the code that made it,
+    # so bumping one parser's version only invalidates that parser's artifacts.
+    INDEX_NAME = 'artifacts.db'
+    TABLE_NAME = 'artifacts'
+
+    def __init__(self, directory=download_cache.CACHE_DIRECTORY):
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(directory, ArtifactCache.INDEX_NAME), isolation_level=None, check_same_thread=False)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("PRAGMA journal_mode=WAL;")
+        self.cursor.execute("PRAGMA synchronous=NORMAL;")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS " + ArtifactCache.TABLE_NAME + """ (
+content_hash TEXT NOT NULL,
+kind TEXT NOT NULL,
+context TEXT NOT NULL,
+version TEXT NOT NULL,
+payload TEXT,
+created_at REAL,
+PRIMARY KEY (content_hash, kind, context)
+);""")
+
+    def get(self, kind, version, content_hash, context=''):
+        # Returns (found, payload) since None is a valid payload, eg an item without votes
+        command = "SELECT version, payload FROM " + ArtifactCache.TABLE_NAME + " WHERE content_hash = ? AND kind = ? AND context = ?;"
+        with self.lock:
+            r = self.cursor.execute(command, (content_hash, kind, context)).fetchone()
+        if r == None or r[0] != str(version):
+            metrics.increment('artifact_cache_requests_total', kind=kind, result='miss')
+            return False, None
+        metrics.increment('artifact_cache_requests_total', kind=kind, result='hit')
+        logging.debug('Reusing cached ' + kind + ' for ' + content_hash)
+        return True, json.loads(r[1])
+
+    def put(self, kind, version, content_hash, payload, context=''):
+        command = "INSERT OR REPLACE INTO " + ArtifactCache.TABLE_NAME + " (content_hash, kind, context, version, payload, created_at) VALUES (?, ?, ?, ?, ?, ?);"
+        with self.lock:
+            self.cursor.execute(command, (content_hash, kind, context, str(version), json.dumps(payload), time.time()))
+
+    def purge(self, kind, version):
+        # Drops artifacts of a kind made by any other version
+        with self.lock:
+            self.cursor.execute("DELETE FROM " + ArtifactCache.TABLE_NAME + " WHERE kind = ? AND version != ?;", (kind, str(version)))
+            return self.cursor.rowcount
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+shared_cache = None
+shared_lock = threading.Lock()
+
+def sharedCache():
+    global shared_cache
+    with shared_lock:
+        if shared_cache == None:
+            shared_cache = ArtifactCache()
+        return shared_cache
+
+def configure(**kwargs):
+    global shared_cache
+    with shared_lock:
+        if shared_cache != None:
+            shared_cache.close()
+        shared_cache = ArtifactCache(**kwargs)
+        return shared_cache
@@ -0,0 +1,346 @@
+import council_members
+import database
+import gc
+from html_table_parser import HTMLTreeParser
+import json
+import legislation
+from legislation import LegislationDatabase
+from legislation import LegislationItem
+import legislation_details
+import legislation_search
+from legislation_details import DetailsDatabase
+from legislation_details import LegislationDetails
+import logging_setup
+from logging_setup import logging
+import os
+import platform
+import random
+import record_votes
+from record_votes import LegislationVote
+from record_votes import VoteParser
+from record_votes import VotesDatabase
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+FIXTURE_HTML = os.path.join(SCRIPT_DIRECTORY, '18-1641.html')
+BASELINE_FORMAT = 1
+DEFAULT_SCALE = 1.0
+DEFAULT_REPEAT = 3
+# Fraction a benchmark may be slower (or use more memory) than the baseline before it fails
+DEFAULT_TOLERANCE = 0.25
+# Growth in peak memory always allowed, small peaks vary by more than the tolerance
+MIN_MEMORY_TOLERANCE = 64 * 1024
+# Synthetic inputs are seeded so every run measures the same documents
+SEED = 1641
+ACTION_DATE = '1/15/2019'
+HTML_VOTES = ['Aye', 'No', 'Absent', 'Abstained', 'Excused']
+FILLER = 'The City Council adopted the following resolution after public comment and discussion. '
+SEARCH_WORDS = ['housing', 'police', 'budget', 'contract', 'park', 'zoning', 'tenant', 'rent', 'library', 'fire',
+    'water', 'sewer', 'grant', 'youth', 'homeless', 'port', 'airport', 'street', 'paving', 'measure', 'appropriation',
+    'agreement', 'amendment', 'ordinance', 'resolution', 'city', 'council', 'fiscal', 'year', 'services']
+# Plain terms, a prefix and a phrase. bm25 scores every match, so a term found in most
+# items, like the shared synthetic description, measures sorting rather than the index.
+SEARCH_QUERIES = ['housing', 'tenant rent', 'pav*', '"police budget"', 'airport', 'homeless services contract']
+
+class Benchmark:
+    # setup(scale) builds the input once, run(input) does the measured work and
+    # returns how many units (documents, items, rows) it processed
+    def __init__(self, name, units, setup, run):
+        self.name = name
+        self.units = units
+        self.setup = setup
+        self.run = run
+
+def scaled(count, scale):
+    return max(1, int(count * scale))
+
+def fileNumber(i):
+    return str(18 + i // 10000) + '-' + str(i % 10000).zfill(4)
+
+def seatedMembers():
+    return [m for m in council_members.MEMBERS if m[2] <= 2019 and m[3] >= 2019]
+
+def syntheticFeed(item_count):
+    # Same shape as the legislation.xml export of the Legistar RSS feed
+    categories = LegislationItem.CATEGORY_TYPES + ['Informational Report']
+    items = []
+    for i in range(item_count):
+        items.append('<item><title>' + fileNumber(i) + '</title>'
+            + '<link>https://oakland.legistar.com/LegislationDetail.aspx?ID=' + str(i) + '</link>'
+            + '<guid>https://oakland.legistar.com/Gateway.aspx?ID=' + str(i) + '</guid>'
+            + '<description>Resolution ' + str(i) + ' on the María García Library &amp; Park</description>'
+            + '<category>' + categories[i % len(categories)] + '</category>'
+            + '<pubDate>Tue, 15 Jan 2019 10:00:00 GMT</pubDate></item>')
+    return '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel><title>Oakland Legislation</title>' + ''.join(items) + '</channel></rss>'
+
+def syntheticVotesHTML(rng, padding_rows):
+    # A votes page with a Person Name table below unrelated layout tables
+    padding = ''.join(['<tr><td>Meeting ' + str(i) + '</td><td>' + FILLER + '</td></tr>' for i in range(padding_rows)])
+    rows = ''.join(['<tr><td>' + m[0] + ' ' + m[1] + '</td><td>' + rng.choice(HTML_VOTES) + '</td></tr>' for m in seatedMembers()])
+    return ('<html><head><title>Votes</title></head><body><div><table><tbody>' + padding + '</tbody></table></div>'
+        + '<div><table><thead><tr><th>Person Name</th><th>Vote</th></tr></thead><tbody>' + rows + '</tbody></table></div></body></html>')
+
+def syntheticVoteText(rng, filler_lines):
+    # Extracted PDF text, where members may be named in the body before the vote block
+    members = [m[1].upper() for m in seatedMembers()]
+    lines = [FILLER + (rng.choice(members) if i % 7 == 0 else '') for i in range(filler_lines)]
+    sections = {keyword: [] for keyword in record_votes.PDF_KEYWORDS[:-1]}
+    for member in members:
+        sections[rng.choice(list(sections.keys()))].append(member)
+    for keyword, names in sections.items():
+        lines.append(keyword + ' - ' + (', '.join(names) if len(names) > 0 else 'NONE'))
+    lines.append('ATTEST: City Clerk and Clerk of the Council')
+    return '\n'.join(lines)
+
+def readFixture():
+    with open(FIXTURE_HTML, 'r') as f:
+        return f.read()
+
+def feedTrees(documents):
+    for html_content in documents:
+        parser = HTMLTreeParser()
+        parser.feed(html_content)
+        parser.get_parsed_trees()
+        parser.close()
+    return len(documents)
+
+def parseTreeDetails(documents):
+    for html_content in documents:
+        legislation_details.loadHTMLDetails(html_content)
+    return len(documents)
+
+def extractDetails(documents):
+    for html_content in documents:
+        legislation_details.extractHTMLDetails(html_content)
+    return len(documents)
+
+def voteParser():
+    return VoteParser(LegislationDetails('18-1641', 'Adopted', None, None, None, ACTION_DATE, None, None))
+
+def parseHTMLVotes(trees):
+    for html_tree in trees:
+        voteParser().parse_from_html(html_tree)
+    return len(trees)
+
+def parsePDFVotes(texts):
+    for raw_text in texts:
+        voteParser().parse_from_pdf(raw_text)
+    return len(texts)
+
+def loadXMLItems(xml_content):
+    return len([legislation.legislationItem(x) for x in legislation.loadXMLItems(xml_content)])
+
+def streamXMLItems(filename):
+    return len([legislation.legislationItem(x) for x in legislation.iterXMLItems(filename)])
+
+def addItems(db_class):
+    def run(items):
+        db = db_class()
+        db.remove_table()
+        db.create_table()
+        with database.transaction():
+            db.add_items(items)
+        return len(items)
+    return run
+
+def searchQueries(queries):
+    index = legislation_search.SearchIndex()
+    for query in queries:
+        index.search(query)
+    return len(queries)
+
+def runProcesses(commands):
+    # Cron and WordPress start a new interpreter per run, so imports are paid every time
+    for command in commands:
+        subprocess.run(command, stdout=subprocess.DEVNULL, check=True)
+    return len(commands)
+
+def benchmarks(work_directory):
+    fixture_copies = lambda scale: [readFixture() for i in range(scaled(20, scale))]
+
+    def votes_html(scale):
+        rng = random.Random(SEED)
+        return [record_votes.extractHTMLTree(syntheticVotesHTML(rng, 50)) for i in range(scaled(200, scale))]
+
+    def vote_texts(scale):
+        rng = random.Random(SEED)
+        return [syntheticVoteText(rng, 200) for i in range(scaled(200, scale))]
+
+    def feed_file(scale):
+        filename = os.path.join(work_directory, 'legislation.xml')
+        with open(filename, 'w', encoding='utf8') as f:
+            f.write(syntheticFeed(scaled(20000, scale)))
+        return filename
+
+    def legislation_rows(scale):
+        return [legislation.legislationItem(x) for x in legislation.loadXMLItems(syntheticFeed(scaled(20000, scale)))]
+
+    def detail_rows(scale):
+        return [LegislationDetails(fileNumber(i), 'Adopted', 'Resolution ' + str(i), FILLER, ACTION_DATE, ACTION_DATE, 'View.ashx?M=F&ID=' + str(i), 'ActionDetails(' + str(i) + ')') for i in range(scaled(20000, scale))]
+
+    def vote_rows(scale):
+        rng = random.Random(SEED)
+        return [LegislationVote(fileNumber(i), member_id, rng.randint(1, 5)) for i in range(scaled(10000, scale)) for member_id in range(1, 9)]
+
+    def search_index(scale):
+        # Titles of random words so common queries match many items and bm25 has to rank them
+        rng = random.Random(SEED)
+        details = [LegislationDetails(fileNumber(i), 'Adopted', 'Resolution ' + str(i), ' '.join([rng.choice(SEARCH_WORDS) for j in range(12)]), ACTION_DATE, ACTION_DATE, None, None) for i in range(scaled(20000, scale))]
+        addItems(LegislationDatabase)(legislation_rows(scale))
+        addItems(DetailsDatabase)(details)
+        return SEARCH_QUERIES * 10
+
+    def fill_startup(scale):
+        # --help exits once every module is imported and the parser is built
+        return [[sys.executable, os.path.join(SCRIPT_DIRECTORY, 'legislation_fill.py'), '--help'] for i in range(scaled(10, scale))]
+
+    return [
+        Benchmark('html_tree_feed', 'documents', fixture_copies, feedTrees),
+        Benchmark('parse_details_tree', 'documents', fixture_copies, parseTreeDetails),
+        Benchmark('parse_details_extract', 'documents', fixture_copies, extractDetails),
+        Benchmark('parse_from_html', 'documents', votes_html, parseHTMLVotes),
+        Benchmark('parse_from_pdf', 'documents', vote_texts, parsePDFVotes),
+        Benchmark('load_xml_items', 'items', lambda scale: syntheticFeed(scaled(20000, scale)), loadXMLItems),
+        Benchmark('stream_xml_items', 'items', feed_file, streamXMLItems),
+        Benchmark('legislation_add_items', 'rows', legislation_rows, addItems(LegislationDatabase)),
+        Benchmark('details_add_items', 'rows', detail_rows, addItems(DetailsDatabase)),
+        Benchmark('votes_add_items', 'rows', vote_rows, addItems(VotesDatabase)),
+        Benchmark('search_queries', 'queries', search_index, searchQueries),
+        Benchmark('startup_legislation_fill', 'processes', fill_startup, runProcesses),
+    ]
+
+def measure(benchmark, scale, repeat):
+    logging.info('Running ' + benchmark.name)
+    benchmark_input = benchmark.setup(scale)
+    seconds = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        count = benchmark.run(benchmark_input)
+        elapsed = time.perf_counter() - start
+        seconds = elapsed if seconds == None else min(seconds, elapsed)
+
+    # A separate traced run, since tracemalloc slows allocation down. Per-process caches
+    # are emptied first so its peak doesn't depend on which benchmarks ran before.
+    clearCaches()
+    gc.collect()
+    tracemalloc.start()
+    benchmark.run(benchmark_input)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        'units': benchmark.units,
+        'count': count,
+        'seconds': seconds,
+        'per_second': count / seconds if seconds > 0 else None,
+        'peak_bytes': peak,
+    }
+
+def clearCaches():
+    council_members.invalidateRoster()
+    record_votes.name_matchers.clear()
+    record_votes.pdf_name_patterns.clear()
+
+def runBenchmarks(scale=DEFAULT_SCALE, repeat=DEFAULT_REPEAT, only=None):
+    work_directory = tempfile.mkdtemp(prefix='c4c-benchmark-')
+    database.configure(path=os.path.join(work_directory, 'benchmark.db'))
+    try:
+        members = council_members.LegislatorDatabase()
+        members.create_table()
+        members.add_members(council_members.MEMBERS)
+        members.close()
+
+        results = {}
+        for benchmark in benchmarks(work_directory):
+            if only == None or benchmark.name in only:
+                results[benchmark.name] = measure(benchmark, scale, repeat)
+    finally:
+        database.manager.close()
+        shutil.rmtree(work_directory, ignore_errors=True)
+
+    return {
+        'format': BASELINE_FORMAT,
+        'scale': scale,
+        'repeat': repeat,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'benchmarks': results,
+    }
+
+def compareResults(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    # Returns a line per regression, throughput and memory are compared separately
+    regressions = []
+    if baseline.get('scale') != report['scale']:
+        logging.warning('Baseline was recorded at scale ' + str(baseline.get('scale')) + ', not ' + str(report['scale']))
+    for name, result in report['benchmarks'].items():
+        expected = baseline.get('benchmarks', {}).get(name)
+        if expected == None:
+            logging.info('No baseline for ' + name)
+            continue
+        if expected.get('per_second') and result['per_second'] != None and result['per_second'] < expected['per_second'] * (1 - tolerance):
+            regressions.append(name + ': {0:.1f} {1}/s, baseline {2:.1f}'.format(result['per_second'], result['units'], expected['per_second']))
+        if expected.get('peak_bytes') and result['peak_bytes'] > expected['peak_bytes'] + max(expected['peak_bytes'] * tolerance, MIN_MEMORY_TOLERANCE):
+            regressions.append(name + ': {0} peak bytes, baseline {1}'.format(result['peak_bytes'], expected['peak_bytes']))
+    return regressions
+
+def main(scale=DEFAULT_SCALE, repeat=DEFAULT_REPEAT, only=None, output=None, baseline=None, tolerance=DEFAULT_TOLERANCE):
+    report = runBenchmarks(scale, repeat, only)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if output != None:
+        with open(output, 'w') as f:
+            f.write(text + '\n')
+    else:
+        print(text)
+
+    if baseline == None:
+        return 0
+    with open(baseline, 'r') as f:
+        regressions = compareResults(report, json.load(f), tolerance)
+    for regression in regressions:
+        logging.error('Regression in ' + regression)
+    return 1 if len(regressions) > 0 else 0
+
+if __name__ == "__main__":
+    parser = logging_setup.argumentParser()
+    parser.add_argument(
+        '--scale',
+        help="Multiplier for the size of the synthetic inputs",
+        type=float, dest="scale",
+        default=DEFAULT_SCALE,
+    )
+    parser.add_argument(
+        '--repeat',
+        help="Timed runs per benchmark, the fastest is reported",
+        type=int, dest="repeat",
+        default=DEFAULT_REPEAT,
+    )
+    parser.add_argument(
+        '--only',
+        help="Only run the named benchmarks",
+        nargs='+', dest="only",
+        default=None,
+    )
+    parser.add_argument(
+        '-o', '--output',
+        help="Write the JSON report to this file instead of stdout",
+        dest="output",
+        default=None,
+    )
+    parser.add_argument(
+        '--baseline',
+        help="JSON report to compare against, eg benchmark_baseline.json, exits with 1 on a regression",
+        dest="baseline",
+        default=None,
+    )
+    parser.add_argument(
+        '--tolerance',
+        help="Allowed slowdown or memory growth against the baseline, as a fraction",
+        type=float, dest="tolerance",
+        default=DEFAULT_TOLERANCE,
+    )
+    args, unused = parser.parse_known_args()
+    sys.exit(main(args.scale, args.repeat, args.only, args.output, args.baseline, args.tolerance))
@@ -0,0 +1,32 @@
+import runpy
+import sys
+
+# Subcommand -> script. A script is only imported when its subcommand runs, so eg
+# c4c.py fill never loads numpy for the matrix or pdfminer before a PDF turns up.
+COMMANDS = {
+    'legislation': 'legislation',
+    'details': 'legislation_details',
+    'votes': 'record_votes',
+    'members': 'council_members',
+    'fill': 'legislation_fill',
+    'search': 'legislation_search',
+    'summary': 'vote_summary',
+    'matrix': 'vote_matrix',
+    'benchmark': 'benchmark',
+}
+
+def usage():
+    return 'usage: c4c.py {' + ','.join(COMMANDS.keys()) + '} [options]\n\nRun c4c.py <command> --help for the options of a command.'
+
+def main(argv):
+    if len(argv) < 2 or argv[1] not in COMMANDS:
+        print(usage())
+        return 0 if len(argv) > 1 and argv[1] in ('-h', '--help') else 2
+    module_name = COMMANDS[argv[1]]
+    # The script sees the same argv as when it is run directly, eg for its --help
+    sys.argv = [module_name + '.py'] + argv[2:]
+    runpy.run_module(module_name, run_name='__main__', alter_sys=True)
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
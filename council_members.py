@@ -1,33 +1,108 @@
+from bisect import bisect_right
+import database
+import datetime
 from logging_setup import logging
-import sqlite3
+import metrics
+import threading
+
+def parseDate(date):
+    # Legistar dates look like 4/16/2019, exact council dates are stored as 2019-04-16
+    if isinstance(date, datetime.date):
+        return date
+    if '-' in date:
+        return datetime.date.fromisoformat(date)
+    month, day, year = date.split('/')
+    return datetime.date(int(year), int(month), int(day))
 
 class Legislator:
-    def __init__(self, member_id, first_name, last_name, start_year, end_year):
+    def __init__(self, member_id, first_name, last_name, start_year, end_year, start_date=None, end_date=None):
         self.member_id = member_id
         self.first_name = first_name
         self.last_name = last_name
         self.start_year = start_year
         self.end_year = end_year
+        self.start_date = start_date
+        self.end_date = end_date
 
     def full_name(self):
         return "{0.first_name} {0.last_name}".format(self)
 
+    def first_day(self):
+        return parseDate(self.start_date) if self.start_date != None else datetime.date(self.start_year, 1, 1)
+
+    def last_day(self):
+        return parseDate(self.end_date) if self.end_date != None else datetime.date(self.end_year, 12, 31)
+
     def was_active_on(self, date):
-        # TODO: use exact start/end dates to avoid false positives
-        year = int(date.split('/')[-1])
-        return self.start_year <= year and year <= self.end_year
+        # Exact start/end dates when known, otherwise the whole of the start and end years
+        day = parseDate(date)
+        return self.first_day() <= day and day <= self.last_day()
+
+class LegislatorRoster:
+    # Splits time at every seat change so "who was seated on date X" is one bisect
+    def __init__(self, legislators):
+        self.legislators = legislators
+        boundaries = set()
+        for legislator in legislators:
+            boundaries.add(legislator.first_day())
+            if legislator.last_day() < datetime.date.max:
+                boundaries.add(legislator.last_day() + datetime.timedelta(days=1))
+        self.boundaries = sorted(boundaries)
+        # Members keep their database order, which VoteParser relies on when matching names
+        self.seated = [[l for l in legislators if l.first_day() <= start and start <= l.last_day()] for start in self.boundaries]
+        self.by_date = {}
+
+    def members_on(self, date):
+        members = self.by_date.get(date)
+        if members == None:
+            i = bisect_right(self.boundaries, parseDate(date)) - 1
+            members = self.seated[i] if i >= 0 else []
+            self.by_date[date] = members
+        return members
+
+roster = None
+roster_rows = None
+roster_data_version = None
+roster_lock = threading.Lock()
+
+def invalidateRoster():
+    global roster, roster_rows, roster_data_version
+    with roster_lock:
+        roster = None
+        roster_rows = None
+        roster_data_version = None
+
+def currentRoster():
+    # One roster per process. Writes through LegislatorDatabase invalidate it, and
+    # sqlite's data_version catches commits from other processes, in which case the
+    # rows are reloaded and the roster is only rebuilt if they actually changed.
+    global roster, roster_rows, roster_data_version
+    with roster_lock:
+        legislators_db = LegislatorDatabase()
+        data_version = legislators_db.data_version()
+        if roster != None and data_version == roster_data_version:
+            return roster
+
+        rows = legislators_db.get_rows()
+        if roster == None or rows != roster_rows:
+            logging.debug('Loading roster of ' + str(len(rows)) + ' council members')
+            roster = LegislatorRoster([Legislator(*r) for r in rows])
+            roster_rows = rows
+        roster_data_version = data_version
+        return roster
 
 class LegislatorDatabase:
     TABLE_NAME = 'council_members'
 
     def __init__(self):
-        self.connection = sqlite3.connect('legislation.db')
+        self.connection = database.connection()
         self.cursor = self.connection.cursor()
 
     def remove_table(self):
         logging.debug('Dropping ' + LegislatorDatabase.TABLE_NAME + ' table')
         command = "DROP TABLE IF EXISTS " + LegislatorDatabase.TABLE_NAME + ";"
         self.cursor.execute(command)
+        invalidateRoster()
 
     def create_table(self):
         logging.debug('Creating ' + LegislatorDatabase.TABLE_NAME + ' table')
@@ -37,31 +112,45 @@ member_id INTEGER PRIMARY KEY,
 name_first TEXT,
 name_last TEXT,
 year_start INTEGER,
-year_end INTEGER
+year_end INTEGER,
+date_start TEXT,
+date_end TEXT
 );""";
         self.cursor.execute(command)
 
     def add_members(self, member_infos):
+        # Each member is (first, last, start year, end year) with optional exact
+        # (start date, end date) as YYYY-MM-DD
         logging.debug('Adding ' + str(len(member_infos)) + ' members to ' + LegislatorDatabase.TABLE_NAME + ' table')
-        keys = ['name_first', 'name_last', 'year_start', 'year_end']
-        all_values = [(m[0].upper(), m[1].upper(), m[2], m[3]) for m in member_infos]
+        keys = ['name_first', 'name_last', 'year_start', 'year_end', 'date_start', 'date_end']
+        all_values = [(m[0].upper(), m[1].upper(), m[2], m[3], m[4] if len(m) > 4 else None, m[5] if len(m) > 5 else None) for m in member_infos]
         command = "INSERT OR REPLACE INTO " + LegislatorDatabase.TABLE_NAME + " (" + ', '.join(keys) + ") VALUES (" + ','.join(['?' for k in keys]) + ");"
-        self.cursor.executemany(command, all_values)
+        with metrics.timed('database_write_seconds', table=LegislatorDatabase.TABLE_NAME):
+            self.cursor.executemany(command, all_values)
+        metrics.increment('database_rows_written_total', len(all_values), table=LegislatorDatabase.TABLE_NAME)
+        invalidateRoster()
+
+    def data_version(self):
+        return self.cursor.execute("PRAGMA data_version;").fetchone()[0]
+
+    def get_rows(self):
+        columns = [r[1] for r in self.cursor.execute("PRAGMA table_info(" + LegislatorDatabase.TABLE_NAME + ");").fetchall()]
+        # Tables created before exact dates were tracked only have years
+        dates = "date_start, date_end" if 'date_start' in columns else "NULL, NULL"
+        command = "SELECT member_id, name_first, name_last, year_start, year_end, " + dates + " FROM " + LegislatorDatabase.TABLE_NAME + ";"
+        return [tuple(r) for r in self.cursor.execute(command).fetchall()]
 
     def get_members(self):
-        command = "SELECT member_id, name_first, name_last, year_start, year_end FROM " + LegislatorDatabase.TABLE_NAME + ";"
-        all_results = self.cursor.execute(command).fetchall()
-        return [Legislator(r[0], r[1], r[2], r[3], r[4]) for r in all_results]
+        return [Legislator(*r) for r in self.get_rows()]
 
     def close(self):
         logging.debug('Closed connection to ' + LegislatorDatabase.TABLE_NAME + ' table')
-        self.connection.commit()
-        self.connection.close()
+        database.commit()
 
-def main():
-    # From Wikipedia, some dates might be a little off.
-    # TODO: use exact days so we can know who was expected to vote on any given item.
-    members = [
+# From Wikipedia, some dates might be a little off.
+# Exact days can be given as two more YYYY-MM-DD values, eg
+# ("Sheng", "Thao", 2018, 9999, "2019-01-07", None)
+MEMBERS = [
     ("Nikki", "Fortunato Bas", 2018, 9999),
     ("Sheng", "Thao", 2018, 9999),
     ("Loren", "Taylor", 2018, 9999),
@@ -85,12 +174,13 @@ def main():
     ("Nate", "Miley", 1996, 2002),
     ("Dick", "Spees", 1996, 2002),
     ("John", "Russo", 1994, 2000)
-    ]
+]
 
+def main():
     database = LegislatorDatabase()
     database.remove_table()
     database.create_table()
-    database.add_members(members)
+    database.add_members(MEMBERS)
     database.close()
 
 if __name__ == "__main__": 
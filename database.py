@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+from logging_setup import logging
+import os
+import sqlite3
+import threading
+
+DATABASE_PATH = 'legislation.db'
+# Prepared statements kept per connection, keyed by SQL text
+STATEMENT_CACHE_SIZE = 256
+# Stays under SQLITE_MAX_VARIABLE_NUMBER on older sqlite builds
+MAX_PARAMETERS = 500
+
+class ConnectionManager:
+    # Hands out one connection per thread (and per process, so forked workers never
+    # share a handle with their parent) and tracks explicit transaction scopes on it
+    def __init__(self, path=DATABASE_PATH, wal=True, synchronous='NORMAL', cache_size=-65536, mmap_size=268435456, busy_timeout=30000):
+        self.path = path
+        self.pragmas = [
+            ('synchronous', synchronous),
+            # Negative sizes are in KiB
+            ('cache_size', cache_size),
+            ('mmap_size', mmap_size),
+            ('busy_timeout', busy_timeout),
+        ]
+        if wal:
+            self.pragmas.insert(0, ('journal_mode', 'WAL'))
+        self.local = threading.local()
+
+    def state(self):
+        if getattr(self.local, 'pid', None) != os.getpid():
+            self.local.pid = os.getpid()
+            self.local.connection = None
+            self.local.depth = 0
+        return self.local
+
+    def connection(self):
+        state = self.state()
+        if state.connection == None:
+            logging.debug('Opening connection to ' + self.path)
+            connection = sqlite3.connect(self.path, cached_statements=STATEMENT_CACHE_SIZE)
+            connection.text_factory = str
+            for name, value in self.pragmas:
+                connection.execute("PRAGMA " + name + "=" + str(value) + ";")
+            state.connection = connection
+        return state.connection
+
+    @contextmanager
+    def transaction(self, immediate=False):
+        # Nested scopes join the outermost one, which commits or rolls back everything.
+        # immediate takes the write lock up front, eg to claim rows before updating them.
+        connection = self.connection()
+        state = self.state()
+        if state.depth == 0:
+            if connection.in_transaction:
+                connection.commit()
+            connection.execute("BEGIN IMMEDIATE;" if immediate else "BEGIN;")
+        state.depth += 1
+        try:
+            yield connection
+        except BaseException:
+            state.depth -= 1
+            if state.depth == 0:
+                connection.rollback()
+            raise
+        state.depth -= 1
+        if state.depth == 0:
+            connection.commit()
+
+    def commit(self):
+        # Commits work done outside a transaction scope, inside one it waits for the scope
+        state = self.state()
+        if state.connection != None and state.depth == 0:
+            state.connection.commit()
+
+    def close(self):
+        state = self.state()
+        if state.connection != None:
+            self.commit()
+            state.connection.close()
+            state.connection = None
+
+manager = ConnectionManager()
+
+def configure(**kwargs):
+    # Replaces the shared manager, eg configure(path='other.db', wal=False)
+    global manager
+    manager.close()
+    manager = ConnectionManager(**kwargs)
+    return manager
+
+def connection():
+    return manager.connection()
+
+def transaction(immediate=False):
+    return manager.transaction(immediate)
+
+def commit():
+    manager.commit()
+
+class TableQueries:
+    # SQL for a table is built once so every call reuses the same cached statement
+    def __init__(self, table_name, columns, indexes=[]):
+        self.table_name = table_name
+        self.columns = columns
+        self.drop = "DROP TABLE IF EXISTS " + table_name + ";"
+        self.select = "SELECT " + ', '.join(columns) + " FROM " + table_name
+        self.select_all = self.select + ";"
+        self.select_by_file_number = self.select + " WHERE file_number = ?;"
+        self.insert = "INSERT OR REPLACE INTO " + table_name + " (" + ', '.join(columns) + ") VALUES (" + ','.join(['?' for c in columns]) + ");"
+        self.create_indexes = ["CREATE INDEX IF NOT EXISTS " + table_name + "_" + column + " ON " + table_name + " (" + column + ");" for column in indexes]
+
+class UpsertCounts:
+    def __init__(self):
+        self.new = 0
+        self.changed = 0
+        self.unchanged = 0
+        self.removed = 0
+        # First key of every new or changed row, eg to reindex just those items
+        self.written = []
+
+    def add(self, other):
+        self.new += other.new
+        self.changed += other.changed
+        self.unchanged += other.unchanged
+        self.removed += other.removed
+        self.written += other.written
+
+    def __str__(self):
+        return "{0.new} new, {0.changed} changed, {0.unchanged} unchanged, {0.removed} removed".format(self)
+
+def chunks(values, size=MAX_PARAMETERS):
+    for i in range(0, len(values), size):
+        yield values[i:i + size]
+
+def upsertRows(cursor, table_name, keys, key_count, rows, replace_groups=False):
+    # Rows are tuples ordered like keys, and the first key_count keys are the primary key.
+    # Only new or changed rows are written. With replace_groups, stored rows that share
+    # a first key with an incoming row but are missing from rows are deleted, eg votes
+    # from members that no longer appear on a re-parsed item.
+    counts = UpsertCounts()
+    incoming = {row[:key_count]: row for row in rows}
+    groups = list({key[0] for key in incoming.keys()})
+
+    existing = {}
+    for group_chunk in chunks(groups):
+        command = "SELECT " + ', '.join(keys) + " FROM " + table_name + " WHERE " + keys[0] + " IN (" + ','.join(['?' for g in group_chunk]) + ");"
+        for r in cursor.execute(command, group_chunk).fetchall():
+            existing[tuple(r[:key_count])] = tuple(r)
+
+    writes = []
+    for key, row in incoming.items():
+        stored = existing.get(key)
+        if stored == None:
+            counts.new += 1
+            writes.append(row)
+        elif stored != tuple(row):
+            counts.changed += 1
+            writes.append(row)
+        else:
+            counts.unchanged += 1
+
+    if len(writes) > 0:
+        cursor.executemany(TableQueries(table_name, keys).insert, writes)
+        counts.written = [row[0] for row in writes]
+
+    if replace_groups:
+        stale = [key for key in existing.keys() if key not in incoming]
+        if len(stale) > 0:
+            command = "DELETE FROM " + table_name + " WHERE " + ' AND '.join([k + " = ?" for k in keys[:key_count]]) + ";"
+            cursor.executemany(command, stale)
+            counts.removed = len(stale)
+
+    logging.debug('Upserted ' + str(len(rows)) + ' rows into ' + table_name + ': ' + str(counts))
+    return counts
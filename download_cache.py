@@ -0,0 +1,256 @@
+import fetch_client
+import gzip
+import hashlib
+from logging_setup import logging
+import metrics
+import os
+import sqlite3
+import threading
+import time
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+CACHE_DIRECTORY = 'cache'
+DEFAULT_MAX_BYTES = 2 * 1024 * 1024 * 1024
+# Seconds before a cached download is revalidated with a conditional GET, None to always trust the cache
+DEFAULT_MAX_AGE = None
+
+def compress(content):
+    if zstandard != None:
+        return 'zst', zstandard.ZstdCompressor(level=10).compress(content)
+    return 'gz', gzip.compress(content, compresslevel=6)
+
+def decompress(codec, stored):
+    if codec == 'zst':
+        if zstandard == None:
+            raise IOError('zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(stored)
+    return gzip.decompress(stored)
+
+def decodeText(content, encoding):
+    # Same fallback as requests' Response.text
+    return content.decode(encoding or 'utf-8', errors='replace')
+
+class CacheEntry:
+    def __init__(self, key, url, content_hash, codec, encoding, etag, last_modified, fetched_at):
+        self.key = key
+        self.url = url
+        self.content_hash = content_hash
+        self.codec = codec
+        self.encoding = encoding
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = fetched_at
+
+class DownloadCache:
+    INDEX_NAME = 'index.db'
+    TABLE_NAME = 'downloads'
+    BLOBS_TABLE_NAME = 'blobs'
+
+    def __init__(self, directory=CACHE_DIRECTORY, max_bytes=DEFAULT_MAX_BYTES, max_age=DEFAULT_MAX_AGE):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        os.makedirs(directory, exist_ok=True)
+        # Shared by fetch worker threads, every use goes through self.lock
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(os.path.join(directory, DownloadCache.INDEX_NAME), isolation_level=None, check_same_thread=False)
+        self.cursor = self.connection.cursor()
+        self.cursor.execute("PRAGMA journal_mode=WAL;")
+        self.cursor.execute("PRAGMA synchronous=NORMAL;")
+        self.create_tables()
+        self.total_bytes = self.cursor.execute("SELECT COALESCE(SUM(stored_size), 0) FROM " + DownloadCache.BLOBS_TABLE_NAME + ";").fetchone()[0]
+
+    def create_tables(self):
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS " + DownloadCache.TABLE_NAME + """ (
+key TEXT NOT NULL PRIMARY KEY,
+url TEXT,
+content_hash TEXT NOT NULL,
+encoding TEXT,
+etag TEXT,
+last_modified TEXT,
+fetched_at REAL,
+accessed_at REAL
+);""")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS downloads_accessed_at ON " + DownloadCache.TABLE_NAME + " (accessed_at);")
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS downloads_content_hash ON " + DownloadCache.TABLE_NAME + " (content_hash);")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS " + DownloadCache.BLOBS_TABLE_NAME + """ (
+content_hash TEXT NOT NULL PRIMARY KEY,
+codec TEXT NOT NULL,
+size INTEGER,
+stored_size INTEGER
+);""")
+
+    def blob_path(self, content_hash, codec):
+        # Two levels of 256 shards keep each directory small
+        return os.path.join(self.directory, content_hash[0:2], content_hash[2:4], content_hash + '.' + codec)
+
+    def lookup(self, key):
+        command = "SELECT d.key, d.url, d.content_hash, b.codec, d.encoding, d.etag, d.last_modified, d.fetched_at FROM " + DownloadCache.TABLE_NAME + " d JOIN " + DownloadCache.BLOBS_TABLE_NAME + " b ON b.content_hash = d.content_hash WHERE d.key = ?;"
+        with self.lock:
+            r = self.cursor.execute(command, (key,)).fetchone()
+        if r == None:
+            return None
+        return CacheEntry(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7])
+
+    def is_fresh(self, entry):
+        return self.max_age == None or time.time() - entry.fetched_at < self.max_age
+
+    def read(self, entry):
+        try:
+            with open(self.blob_path(entry.content_hash, entry.codec), 'rb') as f:
+                return decompress(entry.codec, f.read())
+        except (IOError, OSError) as e:
+            logging.warning('Could not read cached ' + entry.key + ': ' + str(e))
+            return None
+
+    def touch(self, key, revalidated=False):
+        now = time.time()
+        with self.lock:
+            if revalidated:
+                self.cursor.execute("UPDATE " + DownloadCache.TABLE_NAME + " SET accessed_at = ?, fetched_at = ? WHERE key = ?;", (now, now, key))
+            else:
+                self.cursor.execute("UPDATE " + DownloadCache.TABLE_NAME + " SET accessed_at = ? WHERE key = ?;", (now, key))
+
+    def store(self, key, url, content, encoding=None, etag=None, last_modified=None):
+        content_hash = hashlib.sha256(content).hexdigest()
+        with self.lock:
+            existing = self.cursor.execute("SELECT codec FROM " + DownloadCache.BLOBS_TABLE_NAME + " WHERE content_hash = ?;", (content_hash,)).fetchone()
+        if existing == None:
+            codec, stored = compress(content)
+            path = self.blob_path(content_hash, codec)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Unique per process and thread, fill --workers may store the same blob at once
+            temp_path = path + '.' + str(os.getpid()) + '.' + str(threading.get_ident()) + '.tmp'
+            with open(temp_path, 'wb') as f:
+                f.write(stored)
+            os.replace(temp_path, path)
+
+        now = time.time()
+        with self.lock:
+            if existing == None:
+                self.cursor.execute("INSERT OR REPLACE INTO " + DownloadCache.BLOBS_TABLE_NAME + " (content_hash, codec, size, stored_size) VALUES (?, ?, ?, ?);", (content_hash, codec, len(content), len(stored)))
+                self.total_bytes += len(stored)
+            previous = self.cursor.execute("SELECT content_hash FROM " + DownloadCache.TABLE_NAME + " WHERE key = ?;", (key,)).fetchone()
+            self.cursor.execute("INSERT OR REPLACE INTO " + DownloadCache.TABLE_NAME + " (key, url, content_hash, encoding, etag, last_modified, fetched_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?);", (key, url, content_hash, encoding, etag, last_modified, now, now))
+            if previous != None and previous[0] != content_hash:
+                self.release_blob(previous[0])
+            self.evict()
+        logging.debug('Cached ' + key + ' as ' + content_hash)
+
+    def release_blob(self, content_hash):
+        # Caller holds self.lock. Blobs are shared by every key with the same content.
+        in_use = self.cursor.execute("SELECT 1 FROM " + DownloadCache.TABLE_NAME + " WHERE content_hash = ? LIMIT 1;", (content_hash,)).fetchone()
+        if in_use != None:
+            return
+        r = self.cursor.execute("SELECT codec, stored_size FROM " + DownloadCache.BLOBS_TABLE_NAME + " WHERE content_hash = ?;", (content_hash,)).fetchone()
+        if r == None:
+            return
+        self.cursor.execute("DELETE FROM " + DownloadCache.BLOBS_TABLE_NAME + " WHERE content_hash = ?;", (content_hash,))
+        self.total_bytes -= r[1]
+        try:
+            os.remove(self.blob_path(content_hash, r[0]))
+        except OSError:
+            pass
+
+    def evict(self):
+        # Caller holds self.lock. Drops least recently used downloads until under max_bytes.
+        if self.max_bytes == None or self.total_bytes <= self.max_bytes:
+            return
+        command = "SELECT key, content_hash FROM " + DownloadCache.TABLE_NAME + " ORDER BY accessed_at ASC LIMIT 64;"
+        while self.total_bytes > self.max_bytes:
+            oldest = self.cursor.execute(command).fetchall()
+            if len(oldest) == 0:
+                return
+            for key, content_hash in oldest:
+                logging.debug('Evicting ' + key + ' from download cache')
+                self.cursor.execute("DELETE FROM " + DownloadCache.TABLE_NAME + " WHERE key = ?;", (key,))
+                self.release_blob(content_hash)
+                if self.total_bytes <= self.max_bytes:
+                    return
+
+    def import_legacy_file(self, key, url, encoding):
+        # Downloads used to be stored as <key> in the working directory
+        if not os.path.isfile(key):
+            return None
+        with open(key, 'rb') as f:
+            content = f.read()
+        logging.debug('Importing legacy download ' + key + ' into cache')
+        self.store(key, url, content, encoding)
+        return content
+
+    def load(self, key, url, store_locally=False, legacy_encoding=None):
+        entry = self.lookup(key)
+        if entry != None and self.is_fresh(entry):
+            content = self.read(entry)
+            if content != None:
+                logging.debug('Loaded ' + key + ' from cache')
+                self.touch(key)
+                metrics.increment('download_cache_requests_total', result='hit')
+                return content, entry.encoding
+
+        if entry == None:
+            content = self.import_legacy_file(key, url, legacy_encoding)
+            if content != None:
+                metrics.increment('download_cache_requests_total', result='hit')
+                return content, legacy_encoding
+
+        headers = {}
+        if entry != None:
+            if entry.etag != None:
+                headers['If-None-Match'] = entry.etag
+            if entry.last_modified != None:
+                headers['If-Modified-Since'] = entry.last_modified
+
+        logging.info('Requesting ' + url)
+        client = fetch_client.sharedClient()
+        response = client.get(url, headers)
+        if response.status_code == 304 and entry != None:
+            content = self.read(entry)
+            if content != None:
+                logging.debug(key + ' not modified since last fetch')
+                self.touch(key, True)
+                metrics.increment('download_cache_requests_total', result='hit')
+                metrics.increment('download_cache_revalidations_total', result='not_modified')
+                return content, entry.encoding
+            response = client.get(url)
+        # Error pages are never cached, or with no max_age they would be served forever.
+        # Callers see the failure instead, eg a fill job backs off and retries.
+        response.raise_for_status()
+        if response.status_code < 200 or response.status_code >= 300:
+            raise IOError('Unexpected status ' + str(response.status_code) + ' for ' + url)
+
+        content = response.content
+        encoding = response.encoding or response.apparent_encoding
+        metrics.increment('download_cache_requests_total', result='miss')
+        if entry != None:
+            metrics.increment('download_cache_revalidations_total', result='modified')
+        if store_locally or entry != None:
+            self.store(key, url, content, encoding, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+        return content, encoding
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+shared_cache = None
+shared_lock = threading.Lock()
+
+def sharedCache():
+    global shared_cache
+    with shared_lock:
+        if shared_cache == None:
+            shared_cache = DownloadCache()
+        return shared_cache
+
+def configure(**kwargs):
+    # Replaces the shared cache, eg configure(directory='cache', max_age=86400)
+    global shared_cache
+    with shared_lock:
+        if shared_cache != None:
+            shared_cache.close()
+        shared_cache = DownloadCache(**kwargs)
+        return shared_cache
@@ -0,0 +1,419 @@
+from contextlib import contextmanager
+import database
+from email.utils import parsedate_to_datetime
+import heapq
+import itertools
+from logging_setup import logging
+import metrics
+import random
+import threading
+import time
+from urllib.parse import urlparse
+
+# (connect, read) in seconds
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_POOL_SIZE = 8
+DEFAULT_PER_HOST = 4
+# Requests are served lowest priority first, so a --file lookup jumps ahead of backfill
+INTERACTIVE = 0
+BACKFILL = 1
+# Requests per second to each host. The rate starts at DEFAULT_RATE, grows by
+# RATE_INCREASE after every healthy response and is cut by RATE_DECREASE on congestion.
+DEFAULT_RATE = 2.0
+MIN_RATE = 0.1
+MAX_RATE = 20.0
+DEFAULT_BURST = 4
+RATE_INCREASE = 0.05
+RATE_DECREASE = 0.5
+# A response this many times slower than the host's usual latency counts as congestion
+SLOW_RESPONSE_FACTOR = 3.0
+# Weight of the newest response in the usual latency
+LATENCY_SMOOTHING = 0.2
+# Seconds after a cut during which further congestion is the same episode, eg the
+# other responses to a burst that all come back 429
+CONGESTION_WINDOW = 2.0
+# Seconds BACKFILL keeps waiting past the token a waiting INTERACTIVE request is due,
+# so it only holds the host up briefly if that process dies
+INTERACTIVE_HOLD = 1.0
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+CONGESTION_STATUSES = (429, 503)
+MAX_RETRIES = 4
+# Retries wait a random time up to BASE_RETRY_DELAY * 2^attempt, or Retry-After if longer
+BASE_RETRY_DELAY = 1.0
+MAX_RETRY_DELAY = 120.0
+
+def acceptEncoding(compression):
+    if not compression:
+        return 'identity'
+    encodings = ['gzip', 'deflate']
+    try:
+        # urllib3 only decodes brotli when one of these is installed
+        import brotli
+        encodings.append('br')
+    except ImportError:
+        try:
+            import brotlicffi
+            encodings.append('br')
+        except ImportError:
+            pass
+    return ', '.join(encodings)
+
+class FetchStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections_opened = 0
+        self.bytes_received = 0
+
+    def record_connection(self):
+        with self.lock:
+            self.connections_opened += 1
+
+    def record_response(self, byte_count):
+        with self.lock:
+            self.requests += 1
+            self.bytes_received += byte_count
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'requests': self.requests,
+                'connections_opened': self.connections_opened,
+                'connections_reused': max(0, self.requests - self.connections_opened),
+                'bytes_received': self.bytes_received,
+            }
+
+def countingAdapter(stats, **kwargs):
+    # requests and urllib3 take longer to import than the rest of a fill run's startup,
+    # so they are only loaded once a client actually sends something
+    from requests.adapters import HTTPAdapter
+    from urllib3.connectionpool import HTTPConnectionPool
+    from urllib3.connectionpool import HTTPSConnectionPool
+
+    class CountingAdapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+
+            class CountingHTTPConnectionPool(HTTPConnectionPool):
+                def _new_conn(self):
+                    stats.record_connection()
+                    return HTTPConnectionPool._new_conn(self)
+
+            class CountingHTTPSConnectionPool(HTTPSConnectionPool):
+                def _new_conn(self):
+                    stats.record_connection()
+                    return HTTPSConnectionPool._new_conn(self)
+
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': CountingHTTPConnectionPool,
+                'https': CountingHTTPSConnectionPool,
+            }
+
+    return CountingAdapter(**kwargs)
+
+class HostBudgetStore:
+    # Keeps each host's bucket in a sqlite table so every process filling the same
+    # database shares one rate, one set of tokens and one Retry-After pause, and a
+    # waiting INTERACTIVE request in one process holds back BACKFILL in the others
+    TABLE_NAME = 'fetch_hosts'
+    COLUMNS = ['host', 'rate', 'tokens', 'updated', 'paused_until', 'decreased_at', 'latency', 'interactive_until']
+    QUERIES = database.TableQueries(TABLE_NAME, COLUMNS)
+
+    def __init__(self, path):
+        # A connection of its own, so a bucket update never joins a transaction the
+        # caller has open and never holds the write lock across a request
+        self.manager = database.ConnectionManager(path=path)
+        self.created = False
+
+    def transaction(self):
+        if not self.created:
+            self.manager.connection().execute("CREATE TABLE IF NOT EXISTS " + HostBudgetStore.TABLE_NAME + """ (
+host TEXT NOT NULL PRIMARY KEY,
+rate REAL NOT NULL,
+tokens REAL NOT NULL,
+updated REAL NOT NULL,
+paused_until REAL NOT NULL,
+decreased_at REAL,
+latency REAL,
+interactive_until REAL NOT NULL
+);""")
+            self.manager.commit()
+            self.created = True
+        return self.manager.transaction(immediate=True)
+
+    def load(self, bucket):
+        # A host seen for the first time keeps the bucket's starting values
+        r = self.manager.connection().execute(HostBudgetStore.QUERIES.select + " WHERE host = ?;", (bucket.host,)).fetchone()
+        if r != None:
+            bucket.rate, bucket.tokens, bucket.updated, bucket.paused_until, bucket.decreased_at, bucket.latency, bucket.interactive_until = r[1:]
+
+    def save(self, bucket):
+        values = (bucket.host, bucket.rate, bucket.tokens, bucket.updated, bucket.paused_until, bucket.decreased_at, bucket.latency, bucket.interactive_until)
+        self.manager.connection().execute(HostBudgetStore.QUERIES.insert, values)
+
+class HostBucket:
+    # Token bucket for one host whose rate adapts to the server, increasing additively
+    # while responses are healthy and multiplicatively decreasing on 429, 503,
+    # timeouts or a jump in latency. Waiting requests are served in priority order.
+    # With a HostBudgetStore the bucket is shared with other processes, and only the
+    # cap on requests in flight and the queue of waiting threads stay per process.
+    def __init__(self, host, rate, burst, max_in_flight, max_rate, store=None):
+        self.host = host
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_rate = max_rate
+        self.store = store
+        self.condition = threading.Condition()
+        self.tokens = burst
+        # Wall clock times, since they are compared across processes
+        self.updated = time.time()
+        self.in_flight = 0
+        self.paused_until = 0
+        self.decreased_at = None
+        self.latency = None
+        # Until then BACKFILL waits, an INTERACTIVE request is due the next token
+        self.interactive_until = 0
+        self.waiting = []
+        self.sequence = itertools.count()
+
+    @contextmanager
+    def shared_state(self):
+        # Caller holds self.condition
+        if self.store == None:
+            yield
+            return
+        with self.store.transaction():
+            self.store.load(self)
+            yield
+            self.store.save(self)
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + max(0, now - self.updated) * self.rate)
+        self.updated = now
+
+    def take_token(self, ticket):
+        # Caller holds self.condition. Returns 0 once a token is taken, the seconds
+        # to wait for one, or None to wait for another request to finish.
+        if self.waiting[0] != ticket or self.in_flight >= self.max_in_flight:
+            return None
+        priority = ticket[0]
+        with self.shared_state():
+            now = time.time()
+            self.refill(now)
+            wait = max(0, self.paused_until - now, (1 - self.tokens) / self.rate)
+            if priority > INTERACTIVE:
+                wait = max(wait, self.interactive_until - now)
+            elif wait > 0:
+                self.interactive_until = max(self.interactive_until, now + wait + INTERACTIVE_HOLD)
+            if wait == 0:
+                self.tokens -= 1
+                if priority == INTERACTIVE:
+                    self.interactive_until = 0
+        return wait
+
+    def acquire(self, priority):
+        ticket = (priority, next(self.sequence))
+        with self.condition:
+            heapq.heappush(self.waiting, ticket)
+            try:
+                wait = self.take_token(ticket)
+                while wait != 0:
+                    self.condition.wait(wait)
+                    wait = self.take_token(ticket)
+                self.in_flight += 1
+            finally:
+                self.waiting.remove(ticket)
+                heapq.heapify(self.waiting)
+                self.condition.notify_all()
+
+    def release(self):
+        with self.condition:
+            self.in_flight -= 1
+            self.condition.notify_all()
+
+    def pause(self, seconds):
+        # Holds every request to this host, eg for a Retry-After
+        with self.condition, self.shared_state():
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+
+    def record(self, status, seconds):
+        # status is None when the request failed without a response. seconds is the
+        # time to the response headers, a large body taking long to download is not
+        # the server slowing down.
+        with self.condition, self.shared_state():
+            congested = status == None or status in CONGESTION_STATUSES
+            if self.latency != None and seconds > self.latency * SLOW_RESPONSE_FACTOR:
+                congested = True
+            if status != None and status < 400:
+                self.latency = seconds if self.latency == None else self.latency + LATENCY_SMOOTHING * (seconds - self.latency)
+
+            now = time.time()
+            if not congested:
+                self.rate = min(self.max_rate, self.rate + RATE_INCREASE)
+            elif self.decreased_at == None or now - self.decreased_at > CONGESTION_WINDOW:
+                self.rate = max(MIN_RATE, self.rate * RATE_DECREASE)
+                self.decreased_at = now
+                logging.info('Slowing requests to ' + self.host + ' to ' + '{0:.2f}'.format(self.rate) + ' per second')
+                metrics.increment('fetch_rate_decreases_total', host=self.host)
+
+class HostScheduler:
+    def __init__(self, rate, burst, max_in_flight, max_rate, store=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_in_flight = max_in_flight
+        self.max_rate = max_rate
+        self.store = store
+        self.lock = threading.Lock()
+        self.buckets = {}
+
+    def bucket(self, url):
+        host = urlparse(url).netloc
+        with self.lock:
+            bucket = self.buckets.get(host)
+            if bucket == None:
+                bucket = HostBucket(host, self.rate, self.burst, self.max_in_flight, self.max_rate, self.store)
+                self.buckets[host] = bucket
+        return bucket
+
+def retryAfterSeconds(response):
+    # Retry-After is either a number of seconds or an HTTP date
+    value = response.headers.get('Retry-After') if response != None else None
+    if value == None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def retryDelay(attempt):
+    # Full jitter, so clients that failed together don't retry together
+    return random.uniform(0, min(MAX_RETRY_DELAY, BASE_RETRY_DELAY * 2 ** attempt))
+
+request_priority = threading.local()
+
+@contextmanager
+def priority(value):
+    # Requests made on this thread inside the block are served at value, eg
+    # with fetch_client.priority(fetch_client.INTERACTIVE)
+    previous = getattr(request_priority, 'value', BACKFILL)
+    request_priority.value = value
+    try:
+        yield
+    finally:
+        request_priority.value = previous
+
+def currentPriority():
+    return getattr(request_priority, 'value', BACKFILL)
+
+class FetchClient:
+    def __init__(self, timeout=DEFAULT_TIMEOUT, pool_size=DEFAULT_POOL_SIZE, max_per_host=DEFAULT_PER_HOST, compression=True,
+            rate=DEFAULT_RATE, burst=DEFAULT_BURST, max_rate=MAX_RATE, max_retries=MAX_RETRIES, budget_path=None):
+        # With budget_path, hosts' buckets live in that sqlite database and are shared by
+        # every client configured with it. rate then only seeds hosts not seen before.
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.stats = FetchStats()
+        store = HostBudgetStore(budget_path) if budget_path != None else None
+        self.scheduler = HostScheduler(rate, burst, max_per_host, max_rate, store)
+        self.pool_size = pool_size
+        self.max_per_host = max_per_host
+        self.compression = compression
+        self.session = None
+        self.session_lock = threading.Lock()
+
+    def open_session(self):
+        with self.session_lock:
+            if self.session == None:
+                import requests
+                session = requests.Session()
+                session.headers['Accept-Encoding'] = acceptEncoding(self.compression)
+                session.headers['Connection'] = 'keep-alive'
+                # Every worker that may be waiting on a host needs its own pooled connection
+                adapter = countingAdapter(self.stats, pool_connections=self.pool_size, pool_maxsize=max(self.pool_size, self.max_per_host))
+                session.mount('http://', adapter)
+                session.mount('https://', adapter)
+                self.session = session
+            return self.session
+
+    def send(self, bucket, url, headers, priority):
+        # One attempt, returns (response, error)
+        session = self.open_session()
+        import requests
+        bucket.acquire(priority)
+        start = time.perf_counter()
+        try:
+            response = session.get(url, headers=headers, timeout=self.timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            seconds = time.perf_counter() - start
+            metrics.observe('fetch_seconds', seconds)
+            metrics.increment('fetch_errors_total', error=type(e).__name__)
+            bucket.record(None, seconds)
+            return None, e
+        finally:
+            bucket.release()
+        metrics.observe('fetch_seconds', time.perf_counter() - start)
+        # Time to the headers, the whole span also counts downloading the body
+        bucket.record(response.status_code, response.elapsed.total_seconds())
+        try:
+            byte_count = response.raw.tell()
+        except Exception:
+            byte_count = len(response.content)
+        self.stats.record_response(byte_count)
+        metrics.increment('fetch_responses_total', status=response.status_code)
+        metrics.increment('fetch_bytes_total', byte_count)
+        return response, None
+
+    def get(self, url, headers=None, priority=None):
+        # Retries connection errors, timeouts and RETRY_STATUSES. After max_retries the
+        # last response is returned, or the last error raised.
+        if priority == None:
+            priority = currentPriority()
+        bucket = self.scheduler.bucket(url)
+        attempt = 0
+        while True:
+            response, error = self.send(bucket, url, headers, priority)
+            if response != None and response.status_code not in RETRY_STATUSES:
+                return response
+            retry_after = retryAfterSeconds(response)
+            if retry_after != None:
+                # The whole host waits, not just this request
+                bucket.pause(retry_after)
+            if attempt >= self.max_retries or (retry_after != None and retry_after > MAX_RETRY_DELAY):
+                if error != None:
+                    raise error
+                return response
+            delay = max(retryDelay(attempt), retry_after or 0)
+            reason = str(response.status_code) if response != None else type(error).__name__
+            logging.info('Retrying ' + url + ' in ' + '{0:.1f}'.format(delay) + ' seconds after ' + reason)
+            metrics.increment('fetch_retries_total', reason=reason)
+            time.sleep(delay)
+            attempt += 1
+
+    def close(self):
+        logging.debug('Closing fetch client: ' + str(self.stats.as_dict()))
+        if self.session != None:
+            self.session.close()
+
+shared_client = None
+shared_lock = threading.Lock()
+
+def sharedClient():
+    global shared_client
+    with shared_lock:
+        if shared_client == None:
+            shared_client = FetchClient()
+        return shared_client
+
+def configure(**kwargs):
+    # Replaces the shared client, eg configure(max_per_host=2, timeout=(5, 30), rate=1.0)
+    global shared_client
+    with shared_lock:
+        if shared_client != None:
+            shared_client.close()
+        shared_client = FetchClient(**kwargs)
+        return shared_client
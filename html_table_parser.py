@@ -1,63 +1,141 @@
+from bisect import bisect_left
+from bisect import bisect_right
 from html.parser import HTMLParser
+import sys
+from types import MappingProxyType
+
+# Shared by every node without attributes or children, replaced on first child
+NO_ATTRIBUTES = MappingProxyType({})
+NO_CHILDREN = ()
+
+class HTMLTreeIndex:
+	# Positions are document order, so the subtree of a node is the contiguous range
+	# [node.position, node.end] and every query is a bisect into a sorted list
+	def __init__(self):
+		self.nodes = []
+		self.tag_positions = {}
+		self.built = False
+		self.leaf_positions = None
+		self.data_matches = {}
+
+	def add(self, node):
+		node.tree = self
+		node.position = len(self.nodes)
+		node.end = node.position
+		self.nodes.append(node)
+		self.tag_positions.setdefault(node.tag, []).append(node.position)
+		self.invalidate()
+
+	def invalidate(self):
+		# Called for every node and data chunk while parsing, so keep the common case cheap
+		if self.built or len(self.data_matches) > 0:
+			self.built = False
+			self.leaf_positions = None
+			self.data_matches = {}
+
+	def build(self):
+		# Children always come after their parent, so a reverse pass sees every
+		# child's end before the parent needs it
+		if self.built:
+			return
+		for node in reversed(self.nodes):
+			node.end = node.children[-1].end if len(node.children) > 0 else node.position
+		self.leaf_positions = [node.position for node in self.nodes if node.data != None and len(node.children) == 0]
+		self.built = True
+
+	def positions_with_data(self, target):
+		self.build()
+		positions = self.data_matches.get(target)
+		if positions == None:
+			positions = [node.position for node in self.nodes if node.matches_data(target)]
+			self.data_matches[target] = positions
+		return positions
+
+	def in_subtree(self, positions, node):
+		self.build()
+		return positions[bisect_left(positions, node.position):bisect_right(positions, node.end)]
+
+	@staticmethod
+	def of(root):
+		# Indexes a tree that was assembled by hand instead of by HTMLTreeParser
+		index = HTMLTreeIndex()
+		stack = [root]
+		while len(stack) > 0:
+			node = stack.pop()
+			index.add(node)
+			stack.extend(reversed(node.children))
+		return index
 
 class HTMLTreeNode:
+	# Pages produce thousands of nodes, so skip the per-instance __dict__
+	__slots__ = ('tag', 'attrs', 'parent', 'data', 'children', 'tree', 'position', 'end')
+
 	def __init__(self, parent, tag, attrs):
-		self.tag = tag
-		self.attrs = attrs
+		self.tag = sys.intern(tag)
+		self.attrs = attrs if len(attrs) > 0 else NO_ATTRIBUTES
 		self.parent = parent
 		self.data = None
-		self.children = []
+		self.children = NO_CHILDREN
+		self.tree = None
+		self.position = 0
+		self.end = 0
+
+	def add_child(self, child):
+		if self.children is NO_CHILDREN:
+			self.children = []
+		self.children.append(child)
+
+	def index(self):
+		if self.tree == None:
+			root = self
+			while root.parent != None:
+				root = root.parent
+			HTMLTreeIndex.of(root)
+		return self.tree
 
 	def branches_with_tag(self, target):
-		matches = []
-		if self.tag == target:
-			matches.append(self)
-		for child in self.children:
-			matches += child.branches_with_tag(target)
-		return matches
+		tree = self.index()
+		positions = tree.in_subtree(tree.tag_positions.get(target, []), self)
+		return [tree.nodes[p] for p in positions]
 
 	def branches_with_data(self, data):
-		matches = []
-		if self.matches_data(data):
-			matches.append(self)
-		for child in self.children:
-			matches += child.branches_with_data(data)
-		return matches
+		tree = self.index()
+		positions = tree.in_subtree(tree.positions_with_data(data), self)
+		return [tree.nodes[p] for p in positions]
 
 	def branches_matching(self, tag, data, allow_nesting = False):
-		matches = []
-		for child in self.children:
-			matches += child.branches_matching(tag, data, allow_nesting)
-
-		if len(matches) == 0 or allow_nesting:
-			if self.tag == tag and self.branch_has_data(data):
-				matches.append(self)
+		# Tags in this subtree whose own subtree has the data. Without nesting only the
+		# innermost ones are kept, ie those with no matching tag inside them.
+		tree = self.index()
+		data_positions = tree.positions_with_data(data)
+		candidates = []
+		for p in tree.in_subtree(tree.tag_positions.get(tag, []), self):
+			node = tree.nodes[p]
+			i = bisect_left(data_positions, node.position)
+			if i < len(data_positions) and data_positions[i] <= node.end:
+				candidates.append(node)
+
+		if allow_nesting:
+			# Inner tables before the tables that contain them
+			return sorted(candidates, key=lambda node: (node.end, -node.position))
 
+		matches = []
+		for i, node in enumerate(candidates):
+			if i + 1 == len(candidates) or candidates[i + 1].position > node.end:
+				matches.append(node)
 		return matches
 
 	def branch_has_data(self, target):
-		if self.matches_data(target):
-			return True
-
-		for child in self.children:
-			if child.branch_has_data(target):
-				return True
-
-		return False
+		tree = self.index()
+		return len(tree.in_subtree(tree.positions_with_data(target), self)) > 0
 
 	def matches_data(self, target):
 		return self.data != None and target in self.data
 
 	def leaf_data(self):
-		data = []
-		if len(self.children) == 0:
-			if self.data != None:
-				data.append(self.data)
-		else:
-			for child in self.children:
-				data = data + child.leaf_data()
-
-		return data
+		tree = self.index()
+		tree.build()
+		return [tree.nodes[p].data for p in tree.in_subtree(tree.leaf_positions, self)]
 
 	def __str__(self):
 		return self.print(0)
@@ -80,16 +158,19 @@ class HTMLTreeParser(HTMLParser):
         HTMLParser.__init__(self)
         self.roots = []
         self.current_node = None
+        self.tree = HTMLTreeIndex()
 
     def handle_starttag(self, tag, attrs):
-        attributes = { k: v for (k, v) in attrs }
+        attributes = { sys.intern(k): v for (k, v) in attrs }
         if self.current_node == None:
         	self.current_node = HTMLTreeNode(None, tag, attributes)
         	self.roots.append(self.current_node)
+        	self.tree.add(self.current_node)
         else:
         	parent = self.current_node
         	self.current_node = HTMLTreeNode(parent, tag, attributes)
-        	parent.children.append(self.current_node)
+        	parent.add_child(self.current_node)
+        	self.tree.add(self.current_node)
 
     def handle_endtag(self, tag):
         if self.current_node != None:
@@ -100,6 +181,7 @@ class HTMLTreeParser(HTMLParser):
     	stripped = data.rstrip().replace(u'\xa0', ' ')
     	if self.current_node != None and stripped != None:
     		self.current_node.data = stripped
+    		self.tree.invalidate()
 
     def get_parsed_trees(self):
     	return self.roots
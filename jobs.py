@@ -0,0 +1,238 @@
+import database
+from legislation import LegislationDatabase
+from logging_setup import logging
+import os
+from record_votes import VotesDatabase
+import socket
+import threading
+import time
+from vote_summary import VoteSummaryDatabase
+
+# Checkpoints a file number moves through while it is filled. A job that fails keeps
+# the furthest checkpoint it reached so a retry can pick up from there.
+PENDING = 'pending'
+DETAILS_PARSED = 'details_parsed'
+VOTES_PARSED = 'votes_parsed'
+FAILED = 'failed'
+STATES = [PENDING, DETAILS_PARSED, VOTES_PARSED, FAILED]
+
+# Attempts before a job is given up on as failed
+MAX_ATTEMPTS = 5
+# Seconds before the first retry, doubled after every further failure
+BASE_BACKOFF = 3600
+MAX_BACKOFF = 7 * 24 * 60 * 60
+DEFAULT_BATCH_SIZE = 50
+# Seconds a claimed job stays reserved for its worker. Heartbeats renew it while the
+# worker keeps finishing jobs, so it only runs out when a worker has died or hung.
+DEFAULT_LEASE_SECONDS = 300
+
+class FillJob:
+    def __init__(self, file_number, state, attempts, next_attempt_at, last_error, updated_at, lease_owner=None, lease_expires=None):
+        self.file_number = file_number
+        self.state = state
+        self.attempts = attempts
+        self.next_attempt_at = next_attempt_at
+        self.last_error = last_error
+        self.updated_at = updated_at
+        self.lease_owner = lease_owner
+        self.lease_expires = lease_expires
+
+def workerName():
+    return socket.gethostname() + ':' + str(os.getpid())
+
+def backoffSeconds(attempts):
+    return min(MAX_BACKOFF, BASE_BACKOFF * 2 ** max(0, attempts - 1))
+
+class JobsDatabase:
+    TABLE_NAME = 'fill_jobs'
+    COLUMNS = ['file_number', 'state', 'attempts', 'next_attempt_at', 'last_error', 'updated_at', 'lease_owner', 'lease_expires']
+    QUERIES = database.TableQueries(TABLE_NAME, COLUMNS)
+
+    def __init__(self):
+        self.connection = database.connection()
+        self.cursor = self.connection.cursor()
+
+    def remove_table(self):
+        logging.debug('Dropping ' + JobsDatabase.TABLE_NAME + ' table')
+        self.cursor.execute(JobsDatabase.QUERIES.drop)
+
+    def create_table(self):
+        logging.debug('Creating ' + JobsDatabase.TABLE_NAME + ' table')
+        # file_number is plain text here, unlike the utf8 blobs in the legislation table
+        command = "CREATE TABLE IF NOT EXISTS " + JobsDatabase.TABLE_NAME + """ (
+file_number TEXT NOT NULL PRIMARY KEY,
+state TEXT NOT NULL,
+attempts INTEGER NOT NULL DEFAULT 0,
+next_attempt_at REAL,
+last_error TEXT,
+updated_at REAL,
+lease_owner TEXT,
+lease_expires REAL
+);""";
+        self.cursor.execute(command)
+        # Tables created before leases were tracked
+        columns = [r[1] for r in self.cursor.execute("PRAGMA table_info(" + JobsDatabase.TABLE_NAME + ");").fetchall()]
+        for column, column_type in (('lease_owner', 'TEXT'), ('lease_expires', 'REAL')):
+            if column not in columns:
+                self.cursor.execute("ALTER TABLE " + JobsDatabase.TABLE_NAME + " ADD COLUMN " + column + " " + column_type + ";")
+        # Jobs left at the old fetched checkpoint kept nothing to resume from
+        self.cursor.execute("UPDATE " + JobsDatabase.TABLE_NAME + " SET state = ? WHERE state = 'fetched';", (PENDING,))
+        self.cursor.execute("CREATE INDEX IF NOT EXISTS " + JobsDatabase.TABLE_NAME + "_state ON " + JobsDatabase.TABLE_NAME + " (state, next_attempt_at);")
+
+    def fill_job(self, r):
+        return FillJob(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7])
+
+    def get_job(self, file_number):
+        r = self.cursor.execute(JobsDatabase.QUERIES.select_by_file_number, (file_number,)).fetchone()
+        if r == None:
+            return None
+        return self.fill_job(r)
+
+    def enqueue(self, file_number):
+        # Adds a single file number, eg one asked for on the command line
+        self.cursor.execute("INSERT OR IGNORE INTO " + JobsDatabase.TABLE_NAME + " (file_number, state, attempts, updated_at) VALUES (?, ?, 0, ?);", (file_number, PENDING, time.time()))
+        return self.get_job(file_number)
+
+    def enqueue_missing(self):
+        # Adds a job for every legislation item without one. Items that already have
+        # votes, eg from a record_votes run, start out finished.
+        self.remove_placeholder_votes()
+        command = "INSERT OR IGNORE INTO " + JobsDatabase.TABLE_NAME + """ (file_number, state, attempts, updated_at)
+SELECT CAST(ldb.file_number AS TEXT),
+    CASE WHEN EXISTS (SELECT 1 FROM """ + VotesDatabase.TABLE_NAME + """ vdb WHERE vdb.file_number = CAST(ldb.file_number AS TEXT)) THEN ? ELSE ? END,
+    0, ?
+FROM """ + LegislationDatabase.TABLE_NAME + " ldb;"
+        self.cursor.execute(command, (VOTES_PARSED, PENDING, time.time()))
+        if self.cursor.rowcount > 0:
+            logging.info('Queued ' + str(self.cursor.rowcount) + ' new fill jobs')
+        return self.cursor.rowcount
+
+    def remove_placeholder_votes(self):
+        # Failures used to be recorded as a vote of -1 from member -1, which hid the
+        # item from every later run. Dropping them lets those items be retried.
+        command = "SELECT file_number FROM " + VotesDatabase.TABLE_NAME + " WHERE member_id = -1 AND vote_type = -1;"
+        file_numbers = [r[0] for r in self.cursor.execute(command).fetchall()]
+        with VoteSummaryDatabase().tracking(file_numbers):
+            self.cursor.execute("DELETE FROM " + VotesDatabase.TABLE_NAME + " WHERE member_id = -1 AND vote_type = -1;")
+        if self.cursor.rowcount > 0:
+            logging.info('Removed ' + str(self.cursor.rowcount) + ' placeholder votes, those items will be retried')
+
+    def claim(self, owner, batch_size=DEFAULT_BATCH_SIZE, lease_seconds=DEFAULT_LEASE_SECONDS):
+        # Leases unfinished jobs that are not backing off and not leased to a live
+        # worker, newest file numbers first. The write lock is taken before reading
+        # so two workers can never lease the same job.
+        now = time.time()
+        command = JobsDatabase.QUERIES.select + """ WHERE state IN (?, ?)
+AND (next_attempt_at IS NULL OR next_attempt_at <= ?)
+AND (lease_owner IS NULL OR lease_expires <= ?)
+ORDER BY file_number DESC
+LIMIT ?;"""
+        with database.transaction(immediate=True):
+            rows = self.cursor.execute(command, (PENDING, DETAILS_PARSED, now, now, batch_size)).fetchall()
+            claimed = [self.fill_job(r) for r in rows]
+            update = "UPDATE " + JobsDatabase.TABLE_NAME + " SET lease_owner = ?, lease_expires = ? WHERE file_number = ?;"
+            self.cursor.executemany(update, [(owner, now + lease_seconds, job.file_number) for job in claimed])
+        for job in claimed:
+            job.lease_owner = owner
+            job.lease_expires = now + lease_seconds
+        return claimed
+
+    def lease(self, file_number, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        # Takes a job whoever holds it, eg for a file number asked for on the command line
+        command = "UPDATE " + JobsDatabase.TABLE_NAME + " SET lease_owner = ?, lease_expires = ? WHERE file_number = ?;"
+        self.cursor.execute(command, (owner, time.time() + lease_seconds, file_number))
+        return self.get_job(file_number)
+
+    def renew_leases(self, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        command = "UPDATE " + JobsDatabase.TABLE_NAME + " SET lease_expires = ? WHERE lease_owner = ?;"
+        self.cursor.execute(command, (time.time() + lease_seconds, owner))
+        return self.cursor.rowcount
+
+    def release_leases(self, owner):
+        self.cursor.execute("UPDATE " + JobsDatabase.TABLE_NAME + " SET lease_owner = NULL, lease_expires = NULL WHERE lease_owner = ?;", (owner,))
+        return self.cursor.rowcount
+
+    def complete(self, job):
+        # False if the job's lease was lost to another worker, which then owns the result
+        command = "UPDATE " + JobsDatabase.TABLE_NAME + " SET state = ?, next_attempt_at = NULL, last_error = NULL, updated_at = ?, lease_owner = NULL, lease_expires = NULL WHERE file_number = ? AND lease_owner IS ?;"
+        self.cursor.execute(command, (VOTES_PARSED, time.time(), job.file_number, job.lease_owner))
+        return self.cursor.rowcount > 0
+
+    def fail(self, job, checkpoint, error):
+        # Keeps the furthest checkpoint reached and schedules a retry, or gives up
+        # once MAX_ATTEMPTS is reached. False if the job's lease was lost.
+        attempts = job.attempts + 1
+        now = time.time()
+        if attempts >= MAX_ATTEMPTS:
+            state = FAILED
+            next_attempt_at = None
+        else:
+            state = checkpoint
+            next_attempt_at = now + backoffSeconds(attempts)
+        command = "UPDATE " + JobsDatabase.TABLE_NAME + " SET state = ?, attempts = ?, next_attempt_at = ?, last_error = ?, updated_at = ?, lease_owner = NULL, lease_expires = NULL WHERE file_number = ? AND lease_owner IS ?;"
+        self.cursor.execute(command, (state, attempts, next_attempt_at, error, now, job.file_number, job.lease_owner))
+        if self.cursor.rowcount == 0:
+            return False
+        if state == FAILED:
+            logging.warning('Giving up on ' + job.file_number + ' after ' + str(attempts) + ' attempts: ' + error)
+        else:
+            logging.warning('Will retry ' + job.file_number + ' in ' + str(int(next_attempt_at - now)) + ' seconds: ' + error)
+        return True
+
+    def retry_failed(self):
+        command = "UPDATE " + JobsDatabase.TABLE_NAME + " SET state = ?, attempts = 0, next_attempt_at = NULL, updated_at = ? WHERE state = ?;"
+        self.cursor.execute(command, (PENDING, time.time(), FAILED))
+        return self.cursor.rowcount
+
+    def state_counts(self):
+        command = "SELECT state, COUNT(*) FROM " + JobsDatabase.TABLE_NAME + " GROUP BY state;"
+        counts = {state: 0 for state in STATES}
+        for state, count in self.cursor.execute(command).fetchall():
+            counts[state] = count
+        return counts
+
+    def close(self):
+        logging.debug('Closed connection to ' + JobsDatabase.TABLE_NAME + ' table')
+        database.commit()
+
+class LeaseHeartbeat:
+    # Renews every lease held by owner from a background thread, on its own connection.
+    # Renewal stops once the owner has made no progress for lease_seconds, so a worker
+    # stuck on one job lets its batch expire and another worker take it over.
+    def __init__(self, owner, lease_seconds=DEFAULT_LEASE_SECONDS):
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.progressed_at = time.time()
+        self.stalled = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='lease-heartbeat', daemon=True)
+
+    def progress(self):
+        # Called by the owner whenever it claims or finishes a job
+        self.progressed_at = time.time()
+
+    def run(self):
+        while not self.stopped.wait(self.lease_seconds / 3):
+            stalled = time.time() - self.progressed_at
+            if stalled > self.lease_seconds:
+                if not self.stalled:
+                    logging.warning('Not renewing leases for ' + self.owner + ', it has made no progress for ' + str(int(stalled)) + ' seconds')
+                self.stalled = True
+                continue
+            self.stalled = False
+            try:
+                jobs_db = JobsDatabase()
+                renewed = jobs_db.renew_leases(self.owner, self.lease_seconds)
+                jobs_db.close()
+                logging.debug('Renewed ' + str(renewed) + ' leases for ' + self.owner)
+            except Exception as e:
+                logging.warning('Could not renew leases for ' + self.owner + ': ' + str(e))
+        database.manager.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
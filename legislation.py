@@ -1,8 +1,13 @@
+import database
+import legislation_search
+import logging_setup
 from logging_setup import logging
-import requests
-import sqlite3
+import metrics
 import xml.etree.ElementTree as ET
 
+XML_FILENAME = 'legislation.xml'
+DEFAULT_CHUNK_SIZE = 500
+
 class LegislationItem:
     CATEGORY_TYPES = ['City Resolution', 'Ordinance', 'Proclamation', 'JPA Resolution', 'JPFA Resolution', 'ORA Resolution', 'ORSA Resolution']
 
@@ -17,16 +22,16 @@ class LegislationItem:
 
 class LegislationDatabase:
     TABLE_NAME = 'legislation'
+    COLUMNS = ['file_number', 'link', 'guid', 'category', 'publish_date', 'description']
+    QUERIES = database.TableQueries(TABLE_NAME, COLUMNS)
 
     def __init__(self):
-        self.connection = sqlite3.connect('legislation.db')
-        self.connection.text_factory = str
+        self.connection = database.connection()
         self.cursor = self.connection.cursor()
 
     def remove_table(self):
         logging.debug('Dropping legislation table')
-        command = "DROP TABLE IF EXISTS " + LegislationDatabase.TABLE_NAME + ";"
-        self.cursor.execute(command)
+        self.cursor.execute(LegislationDatabase.QUERIES.drop)
 
     def create_table(self):
         logging.debug('Creating legislation table')
@@ -39,33 +44,47 @@ publish_date TEXT,
 description TEXT
 );""";
         self.cursor.execute(command)
-    
+        legislation_search.SearchIndex().create_table()
+
+    def item_values(self, legislation_items):
+        return [(item.file_number, item.link, item.guid, item.category, item.publish_date, item.description) for item in legislation_items]
+
     def add_items(self, legislation_items):
         logging.debug('Adding ' + str(len(legislation_items)) + ' items to ' + LegislationDatabase.TABLE_NAME + ' table')
-        keys = ['file_number', 'link', 'guid', 'category', 'publish_date', 'description']
-        all_values = [(item.file_number, item.link, item.guid, item.category, item.publish_date, item.description) for item in legislation_items]
-        command = "INSERT OR REPLACE INTO " + LegislationDatabase.TABLE_NAME + " (" + ', '.join(keys) + ") VALUES (" + ','.join(['?' for k in keys]) + ");"
-        self.cursor.executemany(command, all_values)
+        with database.transaction(), metrics.timed('database_write_seconds', table=LegislationDatabase.TABLE_NAME):
+            self.cursor.executemany(LegislationDatabase.QUERIES.insert, self.item_values(legislation_items))
+            legislation_search.SearchIndex().sync([item.file_number for item in legislation_items])
+        metrics.increment('database_rows_written_total', len(legislation_items), table=LegislationDatabase.TABLE_NAME)
+
+    def upsert_items(self, legislation_items):
+        with database.transaction(), metrics.timed('database_write_seconds', table=LegislationDatabase.TABLE_NAME):
+            counts = database.upsertRows(self.cursor, LegislationDatabase.TABLE_NAME, LegislationDatabase.COLUMNS, 1, self.item_values(legislation_items))
+            legislation_search.SearchIndex().sync(counts.written)
+        metrics.increment('database_rows_written_total', counts.new + counts.changed, table=LegislationDatabase.TABLE_NAME)
+        return counts
+
+    def legislation_item(self, r):
+        return LegislationItem(r[0], r[1], r[2], r[5], r[3], r[4])
 
     def get_item(self, file_number):
-        keys = ['file_number', 'link', 'guid', 'description', 'category', 'publish_date']
-        command = "SELECT " + ', '.join(keys) + " FROM " + LegislationDatabase.TABLE_NAME + " WHERE file_number LIKE '" + file_number + "';"
-        r = self.cursor.execute(command).fetchone()
-        return LegislationItem(r[0], r[1], r[2], r[3], r[4], r[5])
-    
+        # Items are stored with utf8 encoded values, which sqlite keeps as blobs
+        if isinstance(file_number, str):
+            file_number = file_number.encode('utf8')
+        r = self.cursor.execute(LegislationDatabase.QUERIES.select_by_file_number, (file_number,)).fetchone()
+        if r == None:
+            return None
+        return self.legislation_item(r)
+
     def get_items(self):
-        keys = ['file_number', 'link', 'guid', 'description', 'category', 'publish_date']
-        command = "SELECT " + ', '.join(keys) + " FROM " + LegislationDatabase.TABLE_NAME + ";"
-        all_results = self.cursor.execute(command).fetchall()
-        return [LegislationItem(r[0], r[1], r[2], r[3], r[4], r[5]) for r in all_results]
+        all_results = self.cursor.execute(LegislationDatabase.QUERIES.select_all).fetchall()
+        return [self.legislation_item(r) for r in all_results]
 
     def close(self):
         logging.debug('Closed connection to ' + LegislationDatabase.TABLE_NAME + ' table')
-        self.connection.commit()
-        self.connection.close()
+        database.commit()
 
 def loadXML():
-    filename = 'legislation.xml'
+    filename = XML_FILENAME
     logging.debug('Loading XML with local storage file ' + filename)
     try:
         f = open(filename, 'r')
@@ -81,6 +100,21 @@ def loadXMLItems(xml_content):
     root = ET.fromstring(xml_content)
     return root.findall('./channel/item')
 
+def iterXMLItems(filename):
+    # Yields each ./channel/item as soon as it is complete, then drops it from the
+    # partial tree so memory does not grow with the size of the feed
+    path = []
+    for event, element in ET.iterparse(filename, events=('start', 'end')):
+        if event == 'start':
+            path.append(element)
+            continue
+
+        path.pop()
+        if element.tag == 'item' and len(path) == 2 and path[-1].tag == 'channel':
+            yield element
+            path[-1].remove(element)
+            element.clear()
+
 def legislationItem(xml_item):
     item_info = {child.tag: child.text.encode('utf8') if child.text else None for child in xml_item}
     file_number = item_info.get('title')
@@ -95,27 +129,89 @@ def legislationItem(xml_item):
 
     return LegislationItem(file_number, link, guid, description, category, publish_date)
 
-def exportItems(legislation_items):
-    database = LegislationDatabase()
-    database.remove_table()
-    database.create_table()
-    database.add_items(legislation_items)
-    database.close()
-
-def main(): 
-    xml_content = loadXML()
-    if xml_content == None:
-        return
-
-    xml_items = loadXMLItems(xml_content)
-    legislation_items = [legislationItem(item) for item in xml_items]
+def exportItems(legislation_items, incremental=False):
+    legislation_db = LegislationDatabase()
+    counts = None
+    if incremental:
+        legislation_db.create_table()
+        counts = legislation_db.upsert_items(legislation_items)
+        logging.info('Exported legislation items: ' + str(counts))
+    else:
+        # DDL is transactional in sqlite, so a failed load keeps the old table
+        with database.transaction():
+            legislation_db.remove_table()
+            legislation_db.create_table()
+            legislation_db.add_items(legislation_items)
+    legislation_db.close()
+    return counts
+
+def shouldExport(legislation_item):
     # The following are missing file numbers:
     # https://oakland.legistar.com/Gateway.aspx?M=LD&From=RSS&ID=3998043&GUID=326003A6-5589-4E34-A53E-DD1396EEEF22
     # https://oakland.legistar.com/Gateway.aspx?M=LD&From=RSS&ID=1806565&GUID=B735914F-58C3-4EAA-A1CB-6515F7BEA1AE
     # https://oakland.legistar.com/Gateway.aspx?M=LD&From=RSS&ID=741677&GUID=0B9097EF-D3C1-41C8-B942-E2B8988AEF2B
-    filtered_items = list(filter(lambda x: (x.file_number != None and x.category != None), legislation_items))
-    exportItems(filtered_items)
+    return legislation_item.file_number != None and legislation_item.category != None
+
+def streamItems(filename, chunk_size=DEFAULT_CHUNK_SIZE, incremental=False):
+    logging.debug('Streaming XML items from ' + filename + ' in chunks of ' + str(chunk_size))
+    if incremental:
+        return writeStreamedItems(filename, chunk_size, incremental)
+    # The drop and the full load are one transaction, so a missing or malformed feed
+    # rolls back to the old table instead of leaving it empty or half loaded
+    with database.transaction():
+        return writeStreamedItems(filename, chunk_size, incremental)
+
+def writeStreamedItems(filename, chunk_size, incremental):
+    legislation_db = LegislationDatabase()
+    if not incremental:
+        legislation_db.remove_table()
+    legislation_db.create_table()
+
+    counts = database.UpsertCounts()
+    def write(chunk):
+        if incremental:
+            counts.add(legislation_db.upsert_items(chunk))
+        else:
+            legislation_db.add_items(chunk)
+            counts.new += len(chunk)
+
+    chunk = []
+    for xml_item in iterXMLItems(filename):
+        legislation_item = legislationItem(xml_item)
+        if not shouldExport(legislation_item):
+            continue
+        chunk.append(legislation_item)
+        if len(chunk) >= chunk_size:
+            write(chunk)
+            # Incremental runs commit per chunk, inside the full reload's transaction this waits
+            database.commit()
+            chunk = []
+
+    write(chunk)
+    legislation_db.close()
+    logging.info('Streamed legislation items from ' + filename + ': ' + str(counts))
+    return counts
+
+def main(chunk_size=DEFAULT_CHUNK_SIZE, incremental=False):
+    try:
+        streamItems(XML_FILENAME, chunk_size, incremental)
+    except IOError:
+        logging.error('Local storage file not found')
 
 if __name__ == "__main__": 
-    main() 
+    parser = logging_setup.argumentParser()
+    parser.add_argument(
+        '--chunk-size',
+        help="Number of items to write to the database per transaction",
+        type=int, dest="chunk_size",
+        default=DEFAULT_CHUNK_SIZE,
+    )
+    parser.add_argument(
+        '-i', '--incremental',
+        help="Only write new or changed items instead of rebuilding the table",
+        action="store_true", dest="incremental",
+        default=False,
+    )
+    args, unused = parser.parse_known_args()
+    main(args.chunk_size, args.incremental)
 
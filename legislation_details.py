@@ -1,13 +1,26 @@
+import artifact_cache
+import database
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from contextlib import nullcontext
+import download_cache
+import fetch_client
 from html_table_parser import HTMLTreeNode
 from html_table_parser import HTMLTreeParser
+from html.parser import HTMLParser
+import legislation_search
+import logging_setup
 from logging_setup import logging
-import requests
-import sqlite3
+import metrics
 import xml.etree.ElementTree as ET
 
 from legislation import LegislationItem
 from legislation import LegislationDatabase
 
+DEFAULT_WORKERS = 8
+# Bump whenever parseDetails changes what it returns for the same page
+DETAILS_PARSER_VERSION = 2
+
 class LegislationDetails:
     def __init__(self, file_number, status, name, title, agenda_date, action_date, pdf_link, action_details_link):
         self.file_number = file_number
@@ -19,21 +32,29 @@ class LegislationDetails:
         self.pdf_link = pdf_link
         self.action_details_link = action_details_link
 
+def voteSummary():
+    # The vote summary tables to keep in step with details writes, or None before they
+    # exist. vote_summary imports this module, so it is only imported when needed.
+    import vote_summary
+    summary_db = vote_summary.VoteSummaryDatabase()
+    return summary_db if summary_db.is_available() else None
+
 class DetailsDatabase:
     TABLE_NAME = 'legislation_details'
+    COLUMNS = ['file_number', 'status', 'name', 'title', 'agenda_date', 'action_date', 'pdf_link', 'action_details_link']
+    QUERIES = database.TableQueries(TABLE_NAME, COLUMNS, ['action_date'])
 
     def __init__(self):
-        self.connection = sqlite3.connect('legislation.db')
-        self.connection.text_factory = str
+        self.connection = database.connection()
         self.cursor = self.connection.cursor()
 
     def remove_table(self):
         logging.debug('Dropping ' + DetailsDatabase.TABLE_NAME + ' table')
-        command = "DROP TABLE IF EXISTS " + DetailsDatabase.TABLE_NAME + ";"
-        self.cursor.execute(command)
+        self.cursor.execute(DetailsDatabase.QUERIES.drop)
 
     def create_table(self):
         logging.debug('Creating ' + DetailsDatabase.TABLE_NAME + ' table')
+        existed = self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (DetailsDatabase.TABLE_NAME,)).fetchone() != None
         command = "CREATE TABLE IF NOT EXISTS " + DetailsDatabase.TABLE_NAME + """ (
 file_number TEXT NOT NULL PRIMARY KEY,
 status TEXT,
@@ -46,34 +67,55 @@ action_details_link TEXT,
 FOREIGN KEY (file_number) REFERENCES legislation (file_number)
 );""";
         self.cursor.execute(command)
-    
+        for command in DetailsDatabase.QUERIES.create_indexes:
+            self.cursor.execute(command)
+        legislation_search.SearchIndex().create_table()
+        # Member summaries are by action year, so after a reload every vote starts
+        # from year 0 and moves as its details are written back
+        summary_db = voteSummary()
+        if not existed and summary_db != None:
+            summary_db.rebuild()
+
+    def summary_tracking(self, legislation_details):
+        summary_db = voteSummary()
+        if summary_db == None:
+            return nullcontext()
+        return summary_db.tracking([item.file_number for item in legislation_details])
+
+    def item_values(self, legislation_details):
+        return [(item.file_number, item.status, item.name, item.title, item.agenda_date, item.action_date, item.pdf_link, item.action_details_link) for item in legislation_details]
+
     def add_items(self, legislation_details):
         logging.debug('Adding ' + str(len(legislation_details)) + ' items to ' + DetailsDatabase.TABLE_NAME + ' table')
-        keys = ['file_number', 'status', 'name', 'title', 'agenda_date', 'action_date', 'pdf_link', 'action_details_link']
-        all_values = [(item.file_number, item.status, item.name, item.title, item.agenda_date, item.action_date, item.pdf_link, item.action_details_link) for item in legislation_details]
-        command = "INSERT OR REPLACE INTO " + DetailsDatabase.TABLE_NAME + " (" + ', '.join(keys) + ") VALUES (" + ','.join(['?' for k in keys]) + ");"
-        self.cursor.executemany(command, all_values)
+        with database.transaction(), self.summary_tracking(legislation_details), metrics.timed('database_write_seconds', table=DetailsDatabase.TABLE_NAME):
+            self.cursor.executemany(DetailsDatabase.QUERIES.insert, self.item_values(legislation_details))
+            legislation_search.SearchIndex().sync([item.file_number for item in legislation_details])
+        metrics.increment('database_rows_written_total', len(legislation_details), table=DetailsDatabase.TABLE_NAME)
+
+    def upsert_items(self, legislation_details):
+        with database.transaction(), self.summary_tracking(legislation_details), metrics.timed('database_write_seconds', table=DetailsDatabase.TABLE_NAME):
+            counts = database.upsertRows(self.cursor, DetailsDatabase.TABLE_NAME, DetailsDatabase.COLUMNS, 1, self.item_values(legislation_details))
+            legislation_search.SearchIndex().sync(counts.written)
+        metrics.increment('database_rows_written_total', counts.new + counts.changed, table=DetailsDatabase.TABLE_NAME)
+        return counts
 
     def get_item(self, file_number):
-        keys = ['file_number', 'status', 'name', 'title', 'agenda_date', 'action_date', 'pdf_link', 'action_details_link']
-        command = "SELECT " + ', '.join(keys) + " FROM " + DetailsDatabase.TABLE_NAME + " WHERE file_number LIKE '" + file_number + "';"
-        r = self.cursor.execute(command).fetchone()
-        LegislationDetails(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7])
+        r = self.cursor.execute(DetailsDatabase.QUERIES.select_by_file_number, (file_number,)).fetchone()
+        if r == None:
+            return None
+        return LegislationDetails(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7])
 
     def get_items(self):
-        keys = ['file_number', 'status', 'name', 'title', 'agenda_date', 'action_date', 'pdf_link', 'action_details_link']
-        command = "SELECT " + ', '.join(keys) + " FROM " + DetailsDatabase.TABLE_NAME + ";"
-        all_results = self.cursor.execute(command).fetchall()
+        all_results = self.cursor.execute(DetailsDatabase.QUERIES.select_all).fetchall()
         return [LegislationDetails(r[0], r[1], r[2], r[3], r[4], r[5], r[6], r[7]) for r in all_results]
 
     def close(self):
         logging.debug('Closed connection to ' + DetailsDatabase.TABLE_NAME + ' table')
-        self.connection.commit()
-        self.connection.close()
+        database.commit()
 
 def parseTagValue(tag, data_key, table_tree):
-    leaves = table_tree.branches_matching(tag, data_key)[0].leaf_data()
     try:
+        leaves = table_tree.branches_matching(tag, data_key)[0].leaf_data()
         value = leaves[leaves.index(data_key) + 1]
         logging.debug('Successfully parsed data key ' + data_key + ' with value ' + value)
         return value
@@ -81,13 +123,7 @@ def parseTagValue(tag, data_key, table_tree):
         logging.debug('Could not parse data key ' + data_key)
         return None
 
-def parsePdfLink(table_tree):
-    pdf_branches = table_tree.branches_with_data('CMS')
-    if len(pdf_branches) == 0:
-        logging.debug('Could not parse PDF because there is no CMS data')
-        return None
-
-    hyperlink = pdf_branches[0].attrs.get('href')
+def pdfLink(hyperlink):
     if hyperlink == None:
         logging.debug('Could not parse PDF because there is no hyperlink for the CMS data')
         return None
@@ -96,12 +132,15 @@ def parsePdfLink(table_tree):
     logging.debug('Successfully parsed pdf link ' + hyperlink)
     return pdf_link
 
-def parseActionDetailsLink(table_tree):
-    action_details_branches = table_tree.branches_with_data('Action details')
-    if len(action_details_branches) == 0:
-        logging.debug('Could not parse Action details because they were not found')
+def parsePdfLink(table_tree):
+    pdf_branches = table_tree.branches_with_data('CMS')
+    if len(pdf_branches) == 0:
+        logging.debug('Could not parse PDF because there is no CMS data')
         return None
-    onclick = action_details_branches[0].parent.attrs.get('onclick')
+
+    return pdfLink(pdf_branches[0].attrs.get('href'))
+
+def actionDetailsLink(onclick):
     if onclick == None:
         logging.debug('Could not parse Action details because there is no onclick in the expected location')
         return None
@@ -114,67 +153,305 @@ def parseActionDetailsLink(table_tree):
     logging.debug('Successfully parsed Action details link ' + action_link)
     return action_link
 
+def parseActionDetailsLink(table_tree):
+    action_details_branches = table_tree.branches_with_data('Action details')
+    if len(action_details_branches) == 0:
+        logging.debug('Could not parse Action details because they were not found')
+        return None
+    parent = action_details_branches[0].parent
+    return actionDetailsLink(parent.attrs.get('onclick') if parent != None else None)
+
+def legislationDetails(file_number, status, name, title, agenda_date, action_date, pdf_link, action_details_link):
+    if pdf_link == None and action_details_link == None:
+        logging.warning('Could not parse PDF or Action details for ' + str(file_number))
+
+    return LegislationDetails(file_number, status, name, title, agenda_date, action_date, pdf_link, action_details_link)
+
 def parseDetails(table_tree):
     file_number = parseTagValue('table', 'File #:', table_tree)
     status = parseTagValue('table', 'Status:', table_tree)
     name = parseTagValue('table', 'Name:', table_tree)
     title = parseTagValue('table', 'Title:', table_tree)
-    agenda_date = None # todo, doesn't work with parseTagValue
+    agenda_date = parseTagValue('table', 'On agenda:', table_tree)
     action_date = parseTagValue('table', 'Final action:', table_tree)
     pdf_link = parsePdfLink(table_tree)
     action_details_link = parseActionDetailsLink(table_tree)
+    return legislationDetails(file_number, status, name, title, agenda_date, action_date, pdf_link, action_details_link)
 
-    if pdf_link == None and action_details_link == None:
-        logging.warning('Could not parse PDF or Action details for ' + file_number)
+class StopParsing(Exception):
+    pass
 
-    return LegislationDetails(file_number, status, name, title, agenda_date, action_date, pdf_link, action_details_link)
+class OpenElement:
+    __slots__ = ('tag', 'attrs', 'data', 'has_children', 'leaf_start', 'contains', 'matched')
+
+    def __init__(self, tag, attrs, leaf_start):
+        self.tag = tag
+        self.attrs = attrs
+        self.data = None
+        self.has_children = False
+        self.leaf_start = leaf_start
+        # Field keys found in this subtree, and those already claimed by an inner table
+        self.contains = None
+        self.matched = None
+
+class DetailsFieldExtractor(HTMLParser):
+    # Collects what parseDetails reads from an HTMLTreeParser tree in a single pass,
+    # without building the tree. It keeps the same open-element stack as
+    # HTMLTreeParser (every end tag closes the current element, whatever its name),
+    # so a table's leaves and the innermost table holding a key match the tree.
+    # An element's leaf status and data are final once it closes, and innermost
+    # tables close in document order, so each field is settled when its table closes.
+    FIELD_KEYS = [
+        ('File #:', 'file_number'),
+        ('Status:', 'status'),
+        ('Name:', 'name'),
+        ('Title:', 'title'),
+        ('On agenda:', 'agenda_date'),
+        ('Final action:', 'action_date'),
+    ]
+
+    def __init__(self):
+        HTMLParser.__init__(self)
+        self.stack = []
+        self.leaves = []
+        self.seen_root = False
+        self.fields = {}
+        self.pdf_href = None
+        self.found_pdf = False
+        self.action_onclick = None
+        self.found_action = False
+
+    def complete(self):
+        return len(self.fields) == len(DetailsFieldExtractor.FIELD_KEYS) and self.found_pdf and self.found_action
+
+    def handle_starttag(self, tag, attrs):
+        if len(self.stack) == 0:
+            if self.seen_root:
+                # loadHTMLDetails only reads the first root
+                raise StopParsing()
+            self.seen_root = True
+        else:
+            self.stack[-1].has_children = True
+        self.stack.append(OpenElement(tag, attrs, len(self.leaves)))
+
+    def handle_endtag(self, tag):
+        if len(self.stack) > 0:
+            self.close_element()
+
+    def handle_data(self, data):
+        if len(self.stack) > 0:
+            self.stack[-1].data = data.rstrip().replace(u'\xa0', ' ')
+
+    def close_element(self):
+        element = self.stack.pop()
+        parent = self.stack[-1] if len(self.stack) > 0 else None
+        data = element.data
+
+        if data != None:
+            if not element.has_children:
+                self.leaves.append(data)
+            for key, field in DetailsFieldExtractor.FIELD_KEYS:
+                if field not in self.fields and key in data:
+                    element.contains = (element.contains or set()) | {key}
+            # The tree returns the first such node in document order. Only an
+            # enclosing element's own trailing text could come earlier than the
+            # first one to close, which Legistar pages do not have.
+            if not self.found_pdf and 'CMS' in data:
+                self.found_pdf = True
+                self.pdf_href = dict(element.attrs).get('href')
+            if not self.found_action and 'Action details' in data:
+                self.found_action = True
+                if parent != None:
+                    self.action_onclick = dict(parent.attrs).get('onclick')
+
+        if element.tag == 'table' and element.contains != None:
+            leaves = None
+            for key, field in DetailsFieldExtractor.FIELD_KEYS:
+                if key not in element.contains or field in self.fields:
+                    continue
+                if element.matched != None and key in element.matched:
+                    continue
+                if leaves == None:
+                    leaves = self.leaves[element.leaf_start:]
+                try:
+                    self.fields[field] = leaves[leaves.index(key) + 1]
+                except (ValueError, IndexError):
+                    self.fields[field] = None
+            element.matched = (element.matched or set()) | element.contains
+
+        if parent != None:
+            if element.contains != None:
+                parent.contains = (parent.contains or set()) | element.contains
+            if element.matched != None:
+                parent.matched = (parent.matched or set()) | element.matched
+
+        if self.complete():
+            raise StopParsing()
+
+    def finish(self):
+        while len(self.stack) > 0:
+            self.close_element()
+
+    def details(self):
+        for key, field in DetailsFieldExtractor.FIELD_KEYS:
+            value = self.fields.get(field)
+            if value == None:
+                logging.debug('Could not parse data key ' + key)
+            else:
+                logging.debug('Successfully parsed data key ' + key + ' with value ' + value)
+
+        pdf_link = None
+        if not self.found_pdf:
+            logging.debug('Could not parse PDF because there is no CMS data')
+        else:
+            pdf_link = pdfLink(self.pdf_href)
+
+        action_details_link = None
+        if not self.found_action:
+            logging.debug('Could not parse Action details because they were not found')
+        else:
+            action_details_link = actionDetailsLink(self.action_onclick)
+
+        return legislationDetails(self.fields.get('file_number'), self.fields.get('status'), self.fields.get('name'), self.fields.get('title'), self.fields.get('agenda_date'), self.fields.get('action_date'), pdf_link, action_details_link)
+
+def extractHTMLDetails(html_content):
+    # Same result as loadHTMLDetails, but stops reading once every field is found
+    with metrics.timed('details_parse_seconds', parser='extract'):
+        extractor = DetailsFieldExtractor()
+        try:
+            extractor.feed(html_content)
+            extractor.close()
+            extractor.finish()
+        except StopParsing:
+            pass
+        return extractor.details()
 
 def fetchHTML(url):
     logging.info('Requesting page source from ' + url)
-    request = requests.get(url)
+    request = fetch_client.sharedClient().get(url)
     logging.info("Success!")
     return request.text
 
 def loadHTML(file_number, url, store_locally=False):
-    filename = file_number + ".html"
-    logging.debug('Loading HTML with local storage file ' + filename)
-    try:
-        f = open(filename, 'r')
-        text = f.read()
-        f.close()
-        logging.debug('Loaded from local storage')
-        return text
-    except IOError:
-        logging.debug('Local storage file not found')
-        text = fetchHTML(url)
-        if not store_locally:
-            return text
-        f = open(filename, 'w')
-        f.write(text)
-        f.close()
-        return text
+    key = file_number + ".html"
+    logging.debug('Loading HTML with cache key ' + key)
+    content, encoding = download_cache.sharedCache().load(key, url, store_locally, 'utf-8')
+    return download_cache.decodeText(content, encoding)
 
 def loadHTMLDetails(html_content):
-    parser = HTMLTreeParser()
-    parser.feed(html_content)
-    html_tree = parser.get_parsed_trees()[0]
-    parser.close()
-    return parseDetails(html_tree)
-
-def exportItems(detail_items):
-    database = DetailsDatabase()
-    database.remove_table()
-    database.create_table()
-    database.add_items(detail_items)
-    database.close()
-
-def main(): 
+    with metrics.timed('details_parse_seconds', parser='tree'):
+        parser = HTMLTreeParser()
+        parser.feed(html_content)
+        html_tree = parser.get_parsed_trees()[0]
+        parser.close()
+        return parseDetails(html_tree)
+
+def loadCachedHTMLDetails(html_content):
+    cache = artifact_cache.sharedCache()
+    content_hash = artifact_cache.contentHash(html_content)
+    found, payload = cache.get('details', DETAILS_PARSER_VERSION, content_hash)
+    if found:
+        return LegislationDetails(**payload)
+
+    details_item = extractHTMLDetails(html_content)
+    cache.put('details', DETAILS_PARSER_VERSION, content_hash, vars(details_item))
+    return details_item
+
+def loadDetails(legislation_item, store_locally=False):
+    html_content = loadHTML(legislation_item.file_number.decode('utf8'), legislation_item.link.decode('utf8'), store_locally)
+    return loadCachedHTMLDetails(html_content)
+
+def loadDetailsOrNone(legislation_item, store_locally=False):
+    # A page that can't be downloaded, eg a 404, skips that item rather than the run
+    try:
+        return loadDetails(legislation_item, store_locally)
+    except IOError as e:
+        logging.warning('Skipping ' + legislation_item.file_number.decode('utf8') + ': ' + str(e))
+        return None
+
+def loadAllDetails(legislation_items, store_locally=False, max_workers=DEFAULT_WORKERS):
+    # Yields each item's details as soon as its page has been fetched and parsed,
+    # so completion order is not the order of legislation_items.
+    if max_workers <= 1:
+        for item in legislation_items:
+            details_item = loadDetailsOrNone(item, store_locally)
+            if details_item != None:
+                yield details_item
+        return
+
+    logging.debug('Loading ' + str(len(legislation_items)) + ' detail pages with ' + str(max_workers) + ' workers')
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(loadDetailsOrNone, item, store_locally) for item in legislation_items]
+        for future in as_completed(futures):
+            if future.result() != None:
+                yield future.result()
+
+def exportItems(detail_items, incremental=False):
+    details_db = DetailsDatabase()
+    counts = None
+    if incremental:
+        details_db.create_table()
+        counts = details_db.upsert_items(detail_items)
+        logging.info('Exported legislation details: ' + str(counts))
+    else:
+        details_db.remove_table()
+        details_db.create_table()
+        details_db.add_items(detail_items)
+    details_db.close()
+    return counts
+
+def main(max_workers=DEFAULT_WORKERS, max_per_host=fetch_client.DEFAULT_PER_HOST, incremental=False):
+    client = fetch_client.configure(pool_size=max(max_workers, fetch_client.DEFAULT_POOL_SIZE), max_per_host=max_per_host)
     legislation_db = LegislationDatabase()
     legislation_items = legislation_db.get_items()
-    html_contents = [loadHTML(item.file_number.decode('utf8'), item.link.decode('utf8'), True) for item in legislation_items]
-    detail_items = [loadHTMLDetails(html) for html in html_contents]
-    exportItems(detail_items)
+    legislation_db.close()
+
+    if incremental:
+        counts = writeAllDetails(legislation_items, max_workers, incremental)
+    else:
+        # The drop and every page written are one transaction, so a failed or
+        # interrupted run rolls back to the old table instead of leaving it half filled
+        with database.transaction():
+            counts = writeAllDetails(legislation_items, max_workers, incremental)
+    logging.info('Exported legislation details: ' + str(counts))
+    logging.info('Fetch stats: ' + str(client.stats.as_dict()))
+
+def writeAllDetails(legislation_items, max_workers, incremental):
+    # The database connection stays on this thread, workers only fetch and parse
+    details_db = DetailsDatabase()
+    if not incremental:
+        details_db.remove_table()
+    details_db.create_table()
+    counts = database.UpsertCounts()
+    for details_item in loadAllDetails(legislation_items, True, max_workers):
+        if incremental:
+            counts.add(details_db.upsert_items([details_item]))
+        else:
+            details_db.add_items([details_item])
+            counts.new += 1
+    details_db.close()
+    return counts
 
 if __name__ == "__main__": 
-    main() 
+    parser = logging_setup.argumentParser()
+    parser.add_argument(
+        '-w', '--workers',
+        help="Number of detail pages to fetch and parse concurrently (1 to run serially)",
+        type=int, dest="max_workers",
+        default=DEFAULT_WORKERS,
+    )
+    parser.add_argument(
+        '--per-host',
+        help="Maximum number of concurrent requests to a single host",
+        type=int, dest="max_per_host",
+        default=fetch_client.DEFAULT_PER_HOST,
+    )
+    parser.add_argument(
+        '-i', '--incremental',
+        help="Only write new or changed details instead of rebuilding the table",
+        action="store_true", dest="incremental",
+        default=False,
+    )
+    args, unused = parser.parse_known_args()
+    main(args.max_workers, args.max_per_host, args.incremental) 
 
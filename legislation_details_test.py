@@ -0,0 +1,28 @@
+from legislation_details import extractHTMLDetails
+from legislation_details import loadHTMLDetails
+
+FIELDS = ['file_number', 'status', 'name', 'title', 'agenda_date', 'action_date', 'pdf_link', 'action_details_link']
+
+def main():
+    f = open ('18-1641.html', 'r')
+    html_content = f.read()
+    f.close()
+
+    # The single pass extractor must read every field exactly as the tree parser does
+    extracted = extractHTMLDetails(html_content)
+    loaded = loadHTMLDetails(html_content)
+
+    print('~~~~~~ DETAILS FIELDS ~~~~~~')
+    mismatches = []
+    for field in FIELDS:
+        extracted_value = getattr(extracted, field)
+        loaded_value = getattr(loaded, field)
+        print(field + ': ' + repr(extracted_value))
+        if extracted_value != loaded_value:
+            mismatches.append(field)
+            print('    loadHTMLDetails has ' + repr(loaded_value))
+
+    assert len(mismatches) == 0, 'extractHTMLDetails differs from loadHTMLDetails on ' + ', '.join(mismatches)
+
+if __name__ == "__main__":
+    main()
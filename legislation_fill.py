@@ -1,100 +1,290 @@
-import argparse
-
-parser = argparse.ArgumentParser()
-parser.add_argument(
-	'-c', '--cache',
-	help="Store a local copy of any downloaded files",
-    action="store_true", dest="should_cache",
-    default=False,
-)
-parser.add_argument(
-	'-p', '--poll',
-	help="Poll for all missing legislation items",
-    action="store_true", dest="should_poll",
-    default=False,
-)
-parser.add_argument(
-	'-f', '--file',
-	help="Specify a file id to scrape",
-    dest="file_id",
-)
-args, unused = parser.parse_known_args()
-
+import logging_setup
 from logging_setup import logging
+import artifact_cache
+import database
+import download_cache
+import fetch_client
+import jobs
+from jobs import JobsDatabase
 from legislation import LegislationDatabase
 from legislation_details import DetailsDatabase
 from legislation_details import loadHTML
-from legislation_details import loadHTMLDetails
+from legislation_details import loadCachedHTMLDetails
+import metrics
+import multiprocessing
+import queue
 from record_votes import VotesDatabase
 import record_votes
 
-def fill(file_number, should_cache):
-    logging.info("Will fill voting info for " + file_number)
+def parseArguments():
+    parser = logging_setup.argumentParser()
+    parser.add_argument(
+        '-c', '--cache',
+        help="Store a local copy of any downloaded files",
+        action="store_true", dest="should_cache",
+        default=False,
+    )
+    parser.add_argument(
+        '-p', '--poll',
+        help="Poll for all missing legislation items",
+        action="store_true", dest="should_poll",
+        default=False,
+    )
+    parser.add_argument(
+        '-f', '--file',
+        help="Specify a file id to scrape",
+        dest="file_id",
+    )
+    parser.add_argument(
+        '--database',
+        help="Path of the sqlite database to fill",
+        dest="database_path",
+        default='legislation.db',
+    )
+    parser.add_argument(
+        '--max-age',
+        help="Revalidate cached downloads older than this many seconds",
+        type=int, dest="max_age",
+        default=None,
+    )
+    parser.add_argument(
+        '--batch-size',
+        help="Number of jobs to claim at a time while polling",
+        type=int, dest="batch_size",
+        default=50,
+    )
+    parser.add_argument(
+        '-w', '--workers',
+        help="Number of processes polling at once, each leasing its own batches of jobs",
+        type=int, dest="workers",
+        default=1,
+    )
+    parser.add_argument(
+        '--rate',
+        help="Requests per second to Legistar to start from, adjusted as the server responds and shared by every run on the database",
+        type=float, dest="rate",
+        default=2.0,
+    )
+    parser.add_argument(
+        '--retry-failed',
+        help="Give jobs that ran out of attempts another set of retries",
+        action="store_true", dest="retry_failed",
+        default=False,
+    )
+    args, unused = parser.parse_known_args()
+    return args
+
+def storedDetails(file_number):
+    details_db = DetailsDatabase()
+    details_item = details_db.get_item(file_number)
+    details_db.close()
+    return details_item
 
+def fetchDetailsHTML(file_number, should_cache):
     legislation_db = LegislationDatabase()
     legislation_item = legislation_db.get_item(file_number)
     legislation_db.close()
+    if legislation_item == None:
+        raise ValueError(file_number + ' is not in the ' + LegislationDatabase.TABLE_NAME + ' table')
+    return loadHTML(file_number, legislation_item.link.decode('utf8'), should_cache)
 
-    legislation_details_html = loadHTML(file_number, legislation_item.link.decode('utf8'), should_cache)
-    details_item = loadHTMLDetails(legislation_details_html)
-
-    details_db = DetailsDatabase()
-    details_db.add_items([details_item])
-    details_db.close()
-
+def loadVotes(details_item, should_cache):
     parser = record_votes.VoteParser(details_item)
     all_votes = None
 
     if details_item.action_details_link != None:
         html_content = record_votes.loadHTML(details_item.file_number, details_item.action_details_link, should_cache)
-        html_tree = record_votes.extractHTMLTree(html_content)
-        all_votes = parser.parse_from_html(html_tree)
+        all_votes = record_votes.parseCachedHTMLVotes(parser, html_content)
 
     if all_votes == None and details_item.pdf_link != None:
         pdf_content = record_votes.loadPDF(details_item.file_number, details_item.pdf_link, should_cache)
-        pdf_text = record_votes.extractText(pdf_content)
-        all_votes = parser.parse_from_pdf(pdf_text)
-
-    if all_votes == None:
-        logging.warning('Could not parse ' + file_number)
-        # Add a fake vote so that fillNext() doesn't try this one again
-        all_votes = [record_votes.LegislationVote(file_number, -1, -1)]
-        
-    database = VotesDatabase()
-    database.add_items(all_votes)
-    database.close()
+        # Bounded so one pathological PDF can't stall polling
+        pdf_text = record_votes.extractCachedVoteText(pdf_content, record_votes.DEFAULT_PDF_TIMEOUT)
+        if pdf_text != None:
+            all_votes = record_votes.parseCachedPDFVotes(parser, pdf_text)
+
+    return all_votes
+
+def fill(job, should_cache):
+    # Runs a job from its last checkpoint. New details, votes and the job's state are
+    # written together so each item costs a single commit and a crash loses nothing.
+    logging.info("Will fill voting info for " + job.file_number)
+    checkpoint = job.state if job.state == jobs.DETAILS_PARSED else jobs.PENDING
+    details_item = None
+    new_details = False
+    all_votes = None
+    error = None
+    try:
+        # Details parsed on an earlier attempt are read back instead of fetched again
+        if job.state == jobs.DETAILS_PARSED:
+            details_item = storedDetails(job.file_number)
+        if details_item == None:
+            legislation_details_html = fetchDetailsHTML(job.file_number, should_cache)
+            details_item = loadCachedHTMLDetails(legislation_details_html)
+            if details_item.file_number == None:
+                raise ValueError('No legislation details found for ' + job.file_number)
+            new_details = True
+        checkpoint = jobs.DETAILS_PARSED
+
+        all_votes = loadVotes(details_item, should_cache)
+        if all_votes == None:
+            error = 'Could not parse votes for ' + job.file_number
+    except Exception as e:
+        error = type(e).__name__ + ': ' + str(e)
+
+    with database.transaction():
+        # The job is updated first so nothing is written if its lease was lost
+        jobs_db = JobsDatabase()
+        if error == None:
+            leased = jobs_db.complete(job)
+        else:
+            leased = jobs_db.fail(job, checkpoint, error)
+        jobs_db.close()
+        if not leased:
+            logging.warning('Lease on ' + job.file_number + ' expired before it was filled, leaving it to the worker that took it over')
+            return False
+
+        if new_details:
+            details_db = DetailsDatabase()
+            details_db.add_items([details_item])
+            details_db.close()
+
+        if error == None:
+            votes_db = VotesDatabase()
+            votes_db.add_items(all_votes)
+            votes_db.close()
+    return error == None
+
+def createTables():
+    details_db = DetailsDatabase()
+    details_db.create_table()
+    details_db.close()
 
-def fillNext(should_cache):
-    legislation_db = LegislationDatabase()
     votes_db = VotesDatabase()
-    query = "SELECT file_number FROM " + legislation_db.TABLE_NAME + """ ldb
-    WHERE NOT EXISTS (SELECT NULL 
-        FROM """ + votes_db.TABLE_NAME + """ vdb 
-        WHERE ldb.file_number LIKE vdb.file_number)
-    ORDER BY file_number DESC
-    LIMIT 1;"""
-    logging.debug("Query for missing file numbers: " + query)
-
-    result = legislation_db.cursor.execute(query).fetchone()
-    legislation_db.close()
+    votes_db.create_table()
     votes_db.close()
 
-    if result == None:
+    jobs_db = JobsDatabase()
+    jobs_db.create_table()
+    jobs_db.close()
+
+def prepareJobs(retry_failed=False):
+    createTables()
+    jobs_db = JobsDatabase()
+    with database.transaction():
+        jobs_db.enqueue_missing()
+        if retry_failed:
+            logging.info('Retrying ' + str(jobs_db.retry_failed()) + ' failed jobs')
+    jobs_db.close()
+
+def fillFile(file_number, should_cache):
+    # Runs now whatever state the job is in, eg to refresh a finished item
+    createTables()
+    jobs_db = JobsDatabase()
+    with database.transaction():
+        jobs_db.enqueue(file_number)
+        job = jobs_db.lease(file_number, jobs.workerName())
+    jobs_db.close()
+    if job.state in (jobs.VOTES_PARSED, jobs.FAILED):
+        job.state = jobs.PENDING
+    with fetch_client.priority(fetch_client.INTERACTIVE):
+        return fill(job, should_cache)
+
+def fillBatches(should_cache, batch_size=jobs.DEFAULT_BATCH_SIZE, limit=None, lease_seconds=jobs.DEFAULT_LEASE_SECONDS):
+    # Leases jobs batch_size at a time until none are due, or limit have been run.
+    # Failed jobs back off, so they are not claimed again in the same run.
+    owner = jobs.workerName()
+    filled = 0
+    try:
+        with jobs.LeaseHeartbeat(owner, lease_seconds) as heartbeat:
+            while limit == None or filled < limit:
+                jobs_db = JobsDatabase()
+                batch = jobs_db.claim(owner, batch_size if limit == None else min(batch_size, limit - filled), lease_seconds)
+                jobs_db.close()
+                heartbeat.progress()
+                if len(batch) == 0:
+                    break
+                for job in batch:
+                    fill(job, should_cache)
+                    filled += 1
+                    heartbeat.progress()
+                logging.debug('Claiming another batch')
+    finally:
+        # Hands back anything left of the batch, eg after Ctrl-C
+        jobs_db = JobsDatabase()
+        jobs_db.release_leases(owner)
+        jobs_db.close()
+
+    jobs_db = JobsDatabase()
+    logging.info('Fill jobs: ' + ', '.join([state + ' ' + str(count) for state, count in jobs_db.state_counts().items()]))
+    jobs_db.close()
+    return filled
+
+def fillWorker(database_path, max_age, should_cache, batch_size, rate, results):
+    # Entry point of a --workers process. Caches and connections are opened here,
+    # never inherited from the parent.
+    filled = 0
+    try:
+        database.configure(path=database_path)
+        download_cache.configure(max_age=max_age)
+        artifact_cache.configure()
+        fetch_client.configure(rate=rate, budget_path=database_path)
+        filled = fillBatches(should_cache, batch_size)
+    finally:
+        database.manager.close()
+        results.put((filled, metrics.drain()))
+
+def runWorkers(worker_count, database_path, max_age, should_cache, batch_size, rate=fetch_client.DEFAULT_RATE):
+    # Each worker leases its own batches, so together they cover the backlog once.
+    # Workers draw on one request budget per host, kept in the database.
+    database.manager.close()
+    results = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=fillWorker, args=(database_path, max_age, should_cache, batch_size, rate, results), name='fill-worker-' + str(i)) for i in range(worker_count)]
+    for worker in workers:
+        worker.start()
+    filled = 0
+    reported = 0
+    while reported < len(workers):
+        try:
+            worker_filled, worker_metrics = results.get(timeout=1)
+        except queue.Empty:
+            # A worker that was killed never reports
+            if not any([worker.is_alive() for worker in workers]) and results.empty():
+                break
+            continue
+        reported += 1
+        filled += worker_filled
+        metrics.merge(worker_metrics)
+    for worker in workers:
+        worker.join()
+    logging.info('Workers filled ' + str(filled) + ' items')
+    return filled
+
+def fillNext(should_cache):
+    if fillBatches(should_cache, 1, 1) == 0:
     	logging.info("No file numbers missing votes!")
     	return False
-
-    file_number = result[0].decode('utf8')
-    fill(file_number, should_cache)
     return True
 
 if __name__ == "__main__":
+	args = parseArguments()
 	file_number = args.file_id
 	should_cache = args.should_cache
 	should_poll = args.should_poll
+	database.configure(path=args.database_path)
+	# Shared with other legislation_fill runs on the same database, eg cron and --file
+	fetch_client.configure(rate=args.rate, budget_path=args.database_path)
 	if file_number != None:
-		fill(file_number, should_cache)
+		download_cache.configure(max_age=args.max_age)
+		fillFile(file_number, should_cache)
+	elif should_poll and args.workers > 1:
+		prepareJobs(args.retry_failed)
+		runWorkers(args.workers, args.database_path, args.max_age, should_cache, args.batch_size, args.rate)
 	elif should_poll:
-		while (fillNext(should_cache) == True):
-			logging.debug('Sending another request')
+		download_cache.configure(max_age=args.max_age)
+		prepareJobs(args.retry_failed)
+		fillBatches(should_cache, args.batch_size)
 	else:
+		download_cache.configure(max_age=args.max_age)
+		prepareJobs(args.retry_failed)
 		fillNext(should_cache)
@@ -0,0 +1,203 @@
+import database
+import logging_setup
+from logging_setup import logging
+import re
+import sqlite3
+
+# Same names as LegislationDatabase, DetailsDatabase and vote_summary use. They
+# can't be imported here since legislation and legislation_details import this module.
+LEGISLATION_TABLE_NAME = 'legislation'
+DETAILS_TABLE_NAME = 'legislation_details'
+TALLY_TABLE_NAME = 'item_vote_tally'
+INDEX_TABLE_NAME = 'legislation_search'
+DOCS_TABLE_NAME = 'legislation_search_docs'
+# Indexed columns and their bm25 weights, a match in the title counts for most
+SEARCH_COLUMNS = ['title', 'name', 'description']
+COLUMN_WEIGHTS = [3.0, 2.0, 1.0]
+DEFAULT_LIMIT = 20
+SNIPPET_TOKENS = 12
+# A quoted phrase, or a run of anything but whitespace and quotes
+QUERY_TERMS = re.compile(r'"([^"]*)"|([^\s"]+)')
+
+class SearchResult:
+    def __init__(self, file_number, rank, title, snippet, tally):
+        self.file_number = file_number
+        self.rank = rank
+        self.title = title
+        self.snippet = snippet
+        # {ayes, noes, absent, abstained, excused, other, total} or None without votes
+        self.tally = tally
+
+def searchQuery(text):
+    # Turns what a user typed into an FTS5 expression where every term must match.
+    # "police budget" in quotes is a phrase and hous* is a prefix, anything else is
+    # quoted so punctuation like 18-1641 or O'Brien can't break the query syntax.
+    terms = []
+    for phrase, word in QUERY_TERMS.findall(text):
+        if phrase.strip() != '':
+            terms.append('"' + phrase.strip() + '"')
+        elif word != '':
+            prefix = word.endswith('*')
+            word = word.rstrip('*')
+            if word != '':
+                terms.append('"' + word + '"' + ('*' if prefix else ''))
+    return ' '.join(terms)
+
+class SearchIndex:
+    # An FTS5 index over legislation descriptions and detail titles and names. Each
+    # file number has a stable rowid in DOCS_TABLE_NAME, and its row in the index is
+    # rebuilt from the source tables whenever either of them writes that file number.
+    # available turns False once this sqlite proves to be built without FTS5.
+    available = None
+
+    def __init__(self):
+        self.connection = database.connection()
+        self.cursor = self.connection.cursor()
+
+    def remove_table(self):
+        logging.debug('Dropping ' + INDEX_TABLE_NAME + ' tables')
+        self.cursor.execute("DROP TABLE IF EXISTS " + INDEX_TABLE_NAME + ";")
+        self.cursor.execute("DROP TABLE IF EXISTS " + DOCS_TABLE_NAME + ";")
+
+    def create_table(self):
+        logging.debug('Creating ' + INDEX_TABLE_NAME + ' tables')
+        existed = self.table_exists(INDEX_TABLE_NAME)
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS " + DOCS_TABLE_NAME + """ (
+doc_id INTEGER PRIMARY KEY,
+file_number TEXT NOT NULL UNIQUE
+);""")
+        try:
+            # Porter stemming so "housing" also finds "houses", and prefix indexes so short
+            # prefix* terms read one index entry rather than every term they start
+            self.cursor.execute("CREATE VIRTUAL TABLE IF NOT EXISTS " + INDEX_TABLE_NAME + " USING fts5(" + ', '.join(SEARCH_COLUMNS) + ", prefix = '2 3', tokenize = 'porter unicode61 remove_diacritics 2');")
+            SearchIndex.available = True
+        except sqlite3.OperationalError as e:
+            if SearchIndex.available != False:
+                logging.warning('Legislation search is disabled, this sqlite has no FTS5: ' + str(e))
+            SearchIndex.available = False
+            return
+        # Databases filled before the index existed start from a full index
+        if not existed:
+            self.sync(self.indexed_file_numbers())
+
+    def table_exists(self, table_name):
+        return self.cursor.execute("SELECT 1 FROM sqlite_master WHERE name = ?;", (table_name,)).fetchone() != None
+
+    def is_available(self):
+        # False when sqlite has no FTS5, or the index was never created in this database
+        return SearchIndex.available != False and self.table_exists(INDEX_TABLE_NAME)
+
+    def indexed_file_numbers(self):
+        # Legislation file numbers are utf8 blobs
+        sources = [(LEGISLATION_TABLE_NAME, "CAST(file_number AS TEXT)"), (DETAILS_TABLE_NAME, "file_number")]
+        commands = ["SELECT " + column + " FROM " + table_name for table_name, column in sources if self.table_exists(table_name)]
+        if len(commands) == 0:
+            return []
+        return [r[0] for r in self.cursor.execute(' UNION '.join(commands) + ";").fetchall()]
+
+    def sync(self, file_numbers):
+        # Reindexes file_numbers from the legislation and details tables
+        if not self.is_available():
+            return
+        file_numbers = list({f.decode('utf8') if isinstance(f, bytes) else f for f in file_numbers if f != None})
+        # Either source table may not exist yet, eg while the legislation table is created
+        sources = {table_name: self.table_exists(table_name) for table_name in (LEGISLATION_TABLE_NAME, DETAILS_TABLE_NAME)}
+        description = "CAST(l.description AS TEXT)" if sources[LEGISLATION_TABLE_NAME] else "NULL"
+        title, name = ("d.title", "d.name") if sources[DETAILS_TABLE_NAME] else ("NULL", "NULL")
+        joins = ""
+        if sources[LEGISLATION_TABLE_NAME]:
+            # Legislation values are utf8 blobs, so the key is compared as a blob
+            joins += " LEFT JOIN " + LEGISLATION_TABLE_NAME + " l ON l.file_number = CAST(doc.file_number AS BLOB)"
+        if sources[DETAILS_TABLE_NAME]:
+            joins += " LEFT JOIN " + DETAILS_TABLE_NAME + " d ON d.file_number = doc.file_number"
+        with database.transaction():
+            for file_number_chunk in database.chunks(file_numbers):
+                placeholders = ','.join(['?' for f in file_number_chunk])
+                # Only file numbers indexed before have a row to delete, which saves the
+                # index a lookup per item on the first load
+                indexed = self.cursor.execute("SELECT doc_id FROM " + DOCS_TABLE_NAME + " WHERE file_number IN (" + placeholders + ");", file_number_chunk).fetchall()
+                self.cursor.executemany("DELETE FROM " + INDEX_TABLE_NAME + " WHERE rowid = ?;", indexed)
+                self.cursor.executemany("INSERT OR IGNORE INTO " + DOCS_TABLE_NAME + " (file_number) VALUES (?);", [(f,) for f in file_number_chunk])
+                command = "INSERT INTO " + INDEX_TABLE_NAME + " (rowid, " + ', '.join(SEARCH_COLUMNS) + ") SELECT doc.doc_id, " + ', '.join([title, name, description])
+                command += " FROM " + DOCS_TABLE_NAME + " doc" + joins + " WHERE doc.file_number IN (" + placeholders + ");"
+                self.cursor.execute(command, file_number_chunk)
+
+    def rebuild(self):
+        logging.info('Rebuilding ' + INDEX_TABLE_NAME)
+        with database.transaction():
+            self.remove_table()
+            self.create_table()
+        if self.is_available():
+            self.cursor.execute("INSERT INTO " + INDEX_TABLE_NAME + " (" + INDEX_TABLE_NAME + ") VALUES ('optimize');")
+
+    def search(self, text, limit=DEFAULT_LIMIT):
+        # Best matches first. Text may contain "quoted phrases" and prefix* terms.
+        if not self.is_available():
+            raise RuntimeError('Legislation search needs sqlite with FTS5')
+        query = searchQuery(text)
+        if query == '':
+            return []
+
+        tally_columns = ['ayes', 'noes', 'absent', 'abstained', 'excused', 'other', 'total']
+        with_tallies = self.table_exists(TALLY_TABLE_NAME)
+        command = "SELECT doc.file_number, bm25(" + INDEX_TABLE_NAME + ", " + ', '.join([str(w) for w in COLUMN_WEIGHTS]) + ") AS rank, "
+        command += INDEX_TABLE_NAME + ".title, snippet(" + INDEX_TABLE_NAME + ", -1, '[', ']', '...', " + str(SNIPPET_TOKENS) + ")"
+        if with_tallies:
+            command += ", " + ', '.join(['t.' + c for c in tally_columns])
+        command += " FROM " + INDEX_TABLE_NAME + " JOIN " + DOCS_TABLE_NAME + " doc ON doc.doc_id = " + INDEX_TABLE_NAME + ".rowid"
+        if with_tallies:
+            command += " LEFT JOIN " + TALLY_TABLE_NAME + " t ON t.file_number = doc.file_number"
+        command += " WHERE " + INDEX_TABLE_NAME + " MATCH ? ORDER BY rank LIMIT ?;"
+
+        results = []
+        for r in self.cursor.execute(command, (query, limit)).fetchall():
+            tally = None
+            if with_tallies and r[4] != None:
+                tally = dict(zip(tally_columns, r[4:]))
+            results.append(SearchResult(r[0], r[1], r[2], r[3], tally))
+        return results
+
+    def close(self):
+        logging.debug('Closed connection to ' + INDEX_TABLE_NAME + ' tables')
+        database.commit()
+
+def search(text, limit=DEFAULT_LIMIT):
+    return SearchIndex().search(text, limit)
+
+def main(text=None, limit=DEFAULT_LIMIT, rebuild=False):
+    index = SearchIndex()
+    if rebuild:
+        index.rebuild()
+    else:
+        index.create_table()
+    index.close()
+    if text == None:
+        return
+    for result in search(text, limit):
+        tally = ''
+        if result.tally != None:
+            tally = ' ({0[ayes]} aye, {0[noes]} no, {0[absent]} absent)'.format(result.tally)
+        print(result.file_number + tally + ': ' + (result.title or '') + '\n    ' + result.snippet)
+
+if __name__ == "__main__":
+    parser = logging_setup.argumentParser()
+    parser.add_argument(
+        'text',
+        help="Words to search for, \"quoted phrases\" and prefix* terms are supported",
+        nargs='?',
+        default=None,
+    )
+    parser.add_argument(
+        '-n', '--limit',
+        help="Maximum number of results",
+        type=int, dest="limit",
+        default=DEFAULT_LIMIT,
+    )
+    parser.add_argument(
+        '--rebuild',
+        help="Reindex every legislation item before searching",
+        action="store_true", dest="rebuild",
+        default=False,
+    )
+    args, unused = parser.parse_known_args()
+    main(args.text, args.limit, args.rebuild)
@@ -1,18 +1,44 @@
 import argparse
 import logging
 
-parser = argparse.ArgumentParser()
-parser.add_argument(
-    '-d', '--debug',
-    help="Print debug statements for developer use",
-    action="store_const", dest="loglevel", const=logging.DEBUG,
-    default=logging.WARNING,
-)
-parser.add_argument(
-    '-v', '--verbose',
-    help="Print informational statements about progress",
-    action="store_const", dest="loglevel", const=logging.INFO,
-)
+def addArguments(parser):
+    # Flags every script accepts, read here at import so any module that logs is set up
+    parser.add_argument(
+        '-d', '--debug',
+        help="Print debug statements for developer use",
+        action="store_const", dest="loglevel", const=logging.DEBUG,
+        default=logging.WARNING,
+    )
+    parser.add_argument(
+        '-v', '--verbose',
+        help="Print informational statements about progress",
+        action="store_const", dest="loglevel", const=logging.INFO,
+    )
 
+    parser.add_argument(
+        '--metrics-file',
+        help="Write stage timings and counters here when the run ends, as Prometheus text if it ends in .prom and JSON otherwise",
+        dest="metrics_file",
+        default=None,
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        help="Also rewrite the metrics file every this many seconds",
+        type=float, dest="metrics_interval",
+        default=None,
+    )
+
+def argumentParser():
+    # Parser for a script's own flags whose --help also lists the shared ones
+    parser = argparse.ArgumentParser()
+    addArguments(parser)
+    return parser
+
+# No -h here, it would print only the shared flags and exit before the script's own parser
+parser = argparse.ArgumentParser(add_help=False)
+addArguments(parser)
 args, unused = parser.parse_known_args()
 logging.basicConfig(level=args.loglevel)
+
+import metrics
+metrics.configure(args.metrics_file, args.metrics_interval)
@@ -0,0 +1,238 @@
+import atexit
+from bisect import bisect_left
+from contextlib import contextmanager
+import json
+import logging
+import os
+import threading
+import time
+
+PREFIX = 'c4c_'
+# Upper bounds in seconds, the last bucket (+Inf) is implicit
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min == None else min(self.min, value)
+        self.max = value if self.max == None else max(self.max, value)
+
+    def merge(self, state):
+        for i, count in enumerate(state['counts']):
+            self.counts[i] += count
+        self.count += state['count']
+        self.sum += state['sum']
+        for bound, pick in (('min', min), ('max', max)):
+            if state[bound] != None:
+                current = getattr(self, bound)
+                setattr(self, bound, state[bound] if current == None else pick(current, state[bound]))
+
+    def state(self):
+        return {'counts': list(self.counts), 'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max}
+
+    def quantile(self, q):
+        # Upper bound of the bucket holding the q-th observation, which is as
+        # precise as a fixed bucket histogram gets
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return self.max
+
+def metricKey(name, labels):
+    return (name, tuple(sorted([(k, str(v)) for k, v in labels.items()])))
+
+def labelText(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if len(pairs) == 0:
+        return ''
+    return '{' + ','.join([k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"') + '"' for k, v in pairs]) + '}'
+
+class Registry:
+    # Counters and latency histograms keyed by name and labels. Worker processes
+    # drain() their own registry and the parent merge()s it, since forked
+    # processes do not share memory.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started_at = time.time()
+        self.counters = {}
+        self.histograms = {}
+
+    def increment(self, name, value=1, **labels):
+        key = metricKey(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = metricKey(name, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram == None:
+                histogram = Histogram()
+                self.histograms[key] = histogram
+            histogram.observe(value)
+
+    @contextmanager
+    def timed(self, name, **labels):
+        # Observes the seconds spent in the block, including when it raises
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def drain(self):
+        with self.lock:
+            state = {
+                'counters': [[name, list(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, list(labels), h.state()] for (name, labels), h in self.histograms.items()],
+            }
+            self.counters = {}
+            self.histograms = {}
+        return state
+
+    def merge(self, state):
+        with self.lock:
+            for name, labels, value in state['counters']:
+                key = (name, tuple([tuple(l) for l in labels]))
+                self.counters[key] = self.counters.get(key, 0) + value
+            for name, labels, histogram_state in state['histograms']:
+                key = (name, tuple([tuple(l) for l in labels]))
+                histogram = self.histograms.get(key)
+                if histogram == None:
+                    histogram = Histogram()
+                    self.histograms[key] = histogram
+                histogram.merge(histogram_state)
+
+    def snapshot(self):
+        with self.lock:
+            uptime = time.time() - self.started_at
+            counters = []
+            for (name, labels), value in sorted(self.counters.items()):
+                counters.append({'name': name, 'labels': dict(labels), 'value': value, 'per_second': value / uptime if uptime > 0 else None})
+            histograms = []
+            for (name, labels), h in sorted(self.histograms.items()):
+                histograms.append({
+                    'name': name, 'labels': dict(labels),
+                    'count': h.count, 'sum': h.sum, 'min': h.min, 'max': h.max,
+                    'mean': h.sum / h.count if h.count > 0 else None,
+                    'p50': h.quantile(0.5), 'p95': h.quantile(0.95), 'p99': h.quantile(0.99),
+                })
+            return {'started_at': self.started_at, 'uptime_seconds': uptime, 'counters': counters, 'histograms': histograms, 'hit_rates': self.hit_rates()}
+
+    def hit_rates(self):
+        # Caller holds self.lock. Any counter with a result label of hit or miss,
+        # eg download_cache_requests_total{result="hit"}, gets a hit rate.
+        totals = {}
+        for (name, labels), value in self.counters.items():
+            result = dict(labels).get('result')
+            if result in ('hit', 'miss'):
+                key = name + labelText([l for l in labels if l[0] != 'result'])
+                hits, total = totals.get(key, (0, 0))
+                totals[key] = (hits + (value if result == 'hit' else 0), total + value)
+        return {key: hits / total for key, (hits, total) in sorted(totals.items()) if total > 0}
+
+    def prometheus(self):
+        # Text exposition format, for the node_exporter textfile collector
+        with self.lock:
+            lines = ['# TYPE ' + PREFIX + 'uptime_seconds gauge', PREFIX + 'uptime_seconds ' + repr(time.time() - self.started_at)]
+            typed = set()
+            for (name, labels), value in sorted(self.counters.items()):
+                if name not in typed:
+                    lines.append('# TYPE ' + PREFIX + name + ' counter')
+                    typed.add(name)
+                lines.append(PREFIX + name + labelText(labels) + ' ' + repr(value))
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name not in typed:
+                    lines.append('# TYPE ' + PREFIX + name + ' histogram')
+                    typed.add(name)
+                cumulative = 0
+                for i, count in enumerate(h.counts):
+                    cumulative += count
+                    bound = repr(h.buckets[i]) if i < len(h.buckets) else '+Inf'
+                    lines.append(PREFIX + name + '_bucket' + labelText(labels, [('le', bound)]) + ' ' + str(cumulative))
+                lines.append(PREFIX + name + '_sum' + labelText(labels) + ' ' + repr(h.sum))
+                lines.append(PREFIX + name + '_count' + labelText(labels) + ' ' + str(h.count))
+        return '\n'.join(lines) + '\n'
+
+    def dump(self, path):
+        # Files ending in .prom are written for Prometheus, anything else as JSON.
+        # Written to a temporary file and renamed so readers never see half a dump.
+        if path.endswith('.prom'):
+            text = self.prometheus()
+        else:
+            text = json.dumps(self.snapshot(), indent=2) + '\n'
+        temp_path = path + '.' + str(os.getpid()) + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+        logging.debug('Wrote metrics to ' + path)
+
+registry = Registry()
+dump_path = None
+dump_pid = None
+dump_stop = None
+
+def increment(name, value=1, **labels):
+    registry.increment(name, value, **labels)
+
+def observe(name, value, **labels):
+    registry.observe(name, value, **labels)
+
+def timed(name, **labels):
+    return registry.timed(name, **labels)
+
+def drain():
+    return registry.drain()
+
+def merge(state):
+    registry.merge(state)
+
+def dump(path=None):
+    path = path or dump_path
+    if path == None:
+        return
+    try:
+        registry.dump(path)
+    except (IOError, OSError) as e:
+        logging.warning('Could not write metrics to ' + path + ': ' + str(e))
+
+def dumpAtExit():
+    # Forked workers inherit the atexit hook but must not overwrite the parent's file
+    if os.getpid() == dump_pid:
+        if dump_stop != None:
+            dump_stop.set()
+        dump()
+
+def dumpPeriodically(interval, stop):
+    while not stop.wait(interval):
+        dump()
+
+def configure(path=None, interval=None):
+    # Dumps to path when the process exits, and every interval seconds if given
+    global dump_path, dump_pid, dump_stop
+    if path == None:
+        return
+    first = dump_path == None
+    dump_path = path
+    dump_pid = os.getpid()
+    if first:
+        atexit.register(dumpAtExit)
+    if interval != None and interval > 0 and dump_stop == None:
+        dump_stop = threading.Event()
+        thread = threading.Thread(target=dumpPeriodically, args=(interval, dump_stop), name='metrics-dump', daemon=True)
+        thread.start()
@@ -1,33 +1,62 @@
+import artifact_cache
+from bisect import bisect_right
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+import database
+import download_cache
+import fetch_client
 from html_table_parser import HTMLTreeNode
 from html_table_parser import HTMLTreeParser
 from io import BytesIO
 import logging
-from pdfminer.high_level import extract_text
-import requests
-import sqlite3
+import logging_setup
+import metrics
+import os
+import re
+import signal
+import threading
+import unicodedata
+from vote_summary import VoteSummaryDatabase
 
-from council_members import LegislatorDatabase
+import council_members
 from legislation_details import LegislationDetails
 from legislation_details import DetailsDatabase
 
+DEFAULT_PDF_WORKERS = os.cpu_count() or 1
+# Seconds a single PDF may spend in pdfminer before it is skipped
+DEFAULT_PDF_TIMEOUT = 120
+# The vote block is usually on the last page or two, 0 extracts the whole document
+DEFAULT_TRAILING_PAGES = 2
+PDF_KEYWORDS = ['AYES', 'NOES', 'ABSENT', 'ABSTENTION', 'EXCUSED', 'ATTEST']
+PDF_KEYWORD_PATTERN = re.compile('|'.join(PDF_KEYWORDS))
+# Bump whenever extraction or VoteParser changes what they return for the same input.
+# Cached PDF text is also keyed on the pdfminer release, see pdfTextVersion.
+PDF_TEXT_VERSION = '1'
+VOTES_PARSER_VERSION = 3
+
 class LegislationVote:
-    def __init__(self, file_number, member_id, vote_type):
+    def __init__(self, file_number, member_id, vote_type, confidence=None):
         self.file_number = file_number
         self.member_id = member_id
         self.vote_type = vote_type
+        # Only set by the PDF parser, from 0.0 (not found) to 1.0 (one unambiguous mention)
+        self.confidence = confidence
 
 class VotesDatabase:
     TABLE_NAME = 'legislation_votes'
+    COLUMNS = ['file_number', 'member_id', 'vote_type']
+    # file_number lookups are covered by the (file_number, member_id) primary key
+    QUERIES = database.TableQueries(TABLE_NAME, COLUMNS, ['member_id'])
 
     def __init__(self):
-        self.connection = sqlite3.connect('legislation.db')
-        self.connection.text_factory = str
+        self.connection = database.connection()
         self.cursor = self.connection.cursor()
 
     def remove_table(self):
         logging.debug('Dropping ' + VotesDatabase.TABLE_NAME + ' table')
-        command = "DROP TABLE IF EXISTS " + VotesDatabase.TABLE_NAME + ";"
-        self.cursor.execute(command)
+        self.cursor.execute(VotesDatabase.QUERIES.drop)
+        VoteSummaryDatabase().remove_table()
 
     def create_table(self):
         logging.debug('Creating ' + VotesDatabase.TABLE_NAME + ' table')
@@ -40,33 +69,175 @@ FOREIGN KEY (file_number) REFERENCES legislation (file_number),
 FOREIGN KEY (member_id) REFERENCES council_members (member_id)
 );""";
         self.cursor.execute(command)
+        for command in VotesDatabase.QUERIES.create_indexes:
+            self.cursor.execute(command)
+        VoteSummaryDatabase().create_table()
+
+    def item_values(self, legislation_votes):
+        return [(vote.file_number, vote.member_id, vote.vote_type) for vote in legislation_votes]
 
     def add_items(self, legislation_votes):
         logging.debug('Adding ' + str(len(legislation_votes)) + ' items to ' + VotesDatabase.TABLE_NAME + ' table')
-        keys = ['file_number', 'member_id', 'vote_type']
-        all_values = [(vote.file_number, vote.member_id, vote.vote_type) for vote in legislation_votes]
-        command = "INSERT OR REPLACE INTO " + VotesDatabase.TABLE_NAME + " (" + ', '.join(keys) + ") VALUES (" + ','.join(['?' for k in keys]) + ");"
-        self.cursor.executemany(command, all_values)
-
-    def get_items(self):
-        keys = ['file_number', 'member_id', 'vote_type']
-        command = "SELECT " + ', '.join(keys) + " FROM " + VotesDatabase.TABLE_NAME + ";"
-        all_results = self.cursor.execute(command).fetchall()
+        # The summary tables are updated in the same transaction
+        with VoteSummaryDatabase().tracking([vote.file_number for vote in legislation_votes]):
+            with metrics.timed('database_write_seconds', table=VotesDatabase.TABLE_NAME):
+                self.cursor.executemany(VotesDatabase.QUERIES.insert, self.item_values(legislation_votes))
+        metrics.increment('database_rows_written_total', len(legislation_votes), table=VotesDatabase.TABLE_NAME)
+
+    def upsert_items(self, legislation_votes):
+        # Votes for an item are always parsed together, so any stored vote on the same
+        # item that is not in legislation_votes is stale
+        with VoteSummaryDatabase().tracking([vote.file_number for vote in legislation_votes]):
+            with metrics.timed('database_write_seconds', table=VotesDatabase.TABLE_NAME):
+                counts = database.upsertRows(self.cursor, VotesDatabase.TABLE_NAME, VotesDatabase.COLUMNS, 2, self.item_values(legislation_votes), replace_groups=True)
+        metrics.increment('database_rows_written_total', counts.new + counts.changed, table=VotesDatabase.TABLE_NAME)
+        return counts
+
+    def get_items(self, file_number=None):
+        if file_number != None:
+            all_results = self.cursor.execute(VotesDatabase.QUERIES.select_by_file_number, (file_number,)).fetchall()
+        else:
+            all_results = self.cursor.execute(VotesDatabase.QUERIES.select_all).fetchall()
         return [LegislationVote(r[0], r[1], r[2]) for r in all_results]
 
     def close(self):
         logging.debug('Closed connection to ' + VotesDatabase.TABLE_NAME + ' table')
-        self.connection.commit()
-        self.connection.close()
+        database.commit()
+
+# Dropped from names before matching, eg O'Brien to OBRIEN
+NAME_PUNCTUATION = re.compile(r"['\u2019.]")
+NAME_SEPARATORS = re.compile(r'[^A-Z0-9]+')
+HTML_VOTE_TYPES = {'Aye': 1, 'No': 2, 'Absent': 3, 'Abstained': 4, 'Excused': 5}
+
+def nameTokens(name):
+    # Accent folded and uppercased to match the database, eg Guillén to GUILLEN
+    decomposed = unicodedata.normalize('NFKD', name)
+    folded = ''.join([c for c in decomposed if not unicodedata.combining(c)]).upper()
+    return NAME_SEPARATORS.sub(' ', NAME_PUNCTUATION.sub('', folded)).split()
+
+class NameMatcher:
+    # Maps the last word of each seated member's last name to the member, so a
+    # voter row is matched with one dict lookup per word in the row
+    def __init__(self, legislators):
+        self.by_key = {}
+        self.first_names = {}
+        for legislator in legislators:
+            tokens = nameTokens(legislator.last_name)
+            if len(tokens) > 0:
+                self.by_key.setdefault(tokens[-1], []).append(legislator)
+            self.first_names[legislator.member_id] = set(nameTokens(legislator.first_name))
+        self.ambiguous_keys = sorted([key for key, members in self.by_key.items() if len(members) > 1])
+
+    def match(self, full_name):
+        # Returns the matching member, or None if nobody or more than one member
+        # matches, along with every member the row could refer to
+        tokens = nameTokens(full_name)
+        candidates = []
+        for token in tokens:
+            for legislator in self.by_key.get(token, []):
+                if legislator not in candidates:
+                    candidates.append(legislator)
+
+        if len(candidates) > 1:
+            # Members sharing a surname can still be told apart by first name
+            row_tokens = set(tokens)
+            candidates_by_first_name = [l for l in candidates if len(self.first_names[l.member_id] & row_tokens) > 0]
+            if len(candidates_by_first_name) == 1:
+                return candidates_by_first_name[0], candidates
+
+        if len(candidates) == 1:
+            return candidates[0], candidates
+        return None, candidates
+
+name_matchers = {}
+
+def nameMatcher(legislators):
+    # Built once per distinct set of seated members
+    key = tuple([(l.member_id, l.first_name, l.last_name) for l in legislators])
+    matcher = name_matchers.get(key)
+    if matcher == None:
+        matcher = NameMatcher(legislators)
+        name_matchers[key] = matcher
+        if len(matcher.ambiguous_keys) > 0:
+            logging.info('Seated members share the names ' + ', '.join(matcher.ambiguous_keys) + ', their votes are told apart by first name')
+    return matcher
+
+class PDFVoteSections:
+    # Splits extracted text at the last occurrence of each voting keyword, found in one
+    # pass. Each section runs from its keyword up to the next keyword's start.
+    def __init__(self, raw_text):
+        last_positions = {}
+        for match in PDF_KEYWORD_PATTERN.finditer(raw_text):
+            last_positions[match.group(0)] = match.start()
+        boundaries = sorted([(position, PDF_KEYWORDS.index(keyword)) for keyword, position in last_positions.items()])
+        self.starts = [b[0] for b in boundaries]
+        self.keyword_indexes = [b[1] for b in boundaries]
+
+    def vote_type_at(self, position):
+        # None before the first keyword and after ATTEST, which closes the vote block
+        section = bisect_right(self.starts, position) - 1
+        if section < 0:
+            return None
+        keyword_index = self.keyword_indexes[section]
+        if keyword_index >= len(PDF_KEYWORDS) - 1:
+            return None
+        return keyword_index + 1
+
+class PDFNamePattern:
+    # One alternation over every seated member's last name. The lookahead lets matches
+    # overlap, and longer names are tried first so WANG is not reported as WAN.
+    def __init__(self, legislators):
+        names = sorted({l.last_name for l in legislators}, key = lambda n: (-len(n), n))
+        self.pattern = re.compile('(?=(' + '|'.join([re.escape(n) for n in names]) + '))') if len(names) > 0 else None
+        # A name that prefixes another is hidden wherever the longer one matches
+        self.shadowed = [n for n in names if any([o != n and o.startswith(n) for o in names])]
+
+    def positions(self, raw_text):
+        # Name -> ascending start positions of every occurrence
+        positions = {}
+        if self.pattern == None:
+            return positions
+        for match in self.pattern.finditer(raw_text):
+            positions.setdefault(match.group(1), []).append(match.start())
+        for name in self.shadowed:
+            found = []
+            index = raw_text.find(name)
+            while index != -1:
+                found.append(index)
+                index = raw_text.find(name, index + 1)
+            positions[name] = found
+        return positions
+
+pdf_name_patterns = {}
+
+def pdfNamePattern(legislators):
+    key = tuple([l.last_name for l in legislators])
+    pattern = pdf_name_patterns.get(key)
+    if pattern == None:
+        pattern = PDFNamePattern(legislators)
+        pdf_name_patterns[key] = pattern
+    return pattern
 
 class VoteParser:
     def __init__(self, detail_item):
         self.file_number = detail_item.file_number
         self.action_date = detail_item.action_date
-        legislators_db = LegislatorDatabase()
-        self.legislators = list(filter(lambda l: (l.was_active_on(self.action_date)), legislators_db.get_members()))
+        self.legislators = council_members.currentRoster().members_on(self.action_date)
+        # (voter name, [candidate full names]) for rows that matched several members
+        self.ambiguities = []
+
+    def cache_context(self):
+        # Parsed votes depend on the item and on who was seated, not just the source text
+        roster = ';'.join([str(l.member_id) + ':' + l.full_name() for l in self.legislators])
+        return self.file_number + '|' + str(self.action_date) + '|' + artifact_cache.contentHash(roster)
 
     def parse_from_html(self, html_tree):
+        with metrics.timed('vote_parse_seconds', source='html'):
+            votes = self.parse_html_votes(html_tree)
+        metrics.increment('votes_parsed_total', len(votes or []), source='html')
+        return votes
+
+    def parse_html_votes(self, html_tree):
         votes_table = html_tree.branches_matching('table', 'Person Name')
         votes_body = votes_table[0].branches_with_tag('tbody')
         votes_entries = votes_body[0].leaf_data()
@@ -75,110 +246,285 @@ class VoteParser:
             logging.debug('No individual voting record in html for ' + self.file_number)
             return None
 
-        keywords = ['Aye', 'No', 'Absent', 'Abstained', 'Excused']
+        matcher = nameMatcher(self.legislators)
         votes = []
         for i in range(0, len(votes_entries), 2):
-            # Normalize and uppercase names to match DB, eg Guillén to GUILLEN
-            # Could use unidecode library if there are more cases needed
-            full_name = votes_entries[i].replace('é', 'e').upper()
+            full_name = votes_entries[i]
             vote = votes_entries[i+1]
-            matching_legislator = None
-            vote_type = -1
-            for legislator in self.legislators:
-                if legislator.last_name.split(' ')[-1] in full_name:
-                    matching_legislator = legislator
-                    try:
-                        vote_type = keywords.index(vote) + 1
-                        break
-                    except ValueError:
-                        logging.warning('Could not find how ' + legislator.full_name() + ' voted (' + vote + ') on ' + self.file_number)
-                        break
+            matching_legislator, candidates = matcher.match(full_name)
+
+            if matching_legislator == None and len(candidates) > 1:
+                candidate_names = [l.full_name() for l in candidates]
+                self.ambiguities.append((full_name, candidate_names))
+                metrics.increment('votes_ambiguous_total')
+                logging.warning('Not recording vote (' + vote + ') from ' + full_name + ' on ' + self.file_number + ' because it could be any of ' + ', '.join(candidate_names))
+                continue
 
             if matching_legislator == None:
                 logging.warning('Could not find legislator ' + full_name + ' who voted (' + vote + ') on ' + self.file_number)
-            else:
-                logging.debug('Adding legislation vote of ' + str(vote_type) + ' from ' + str(matching_legislator.full_name()) + ' on ' + self.file_number)
-                votes.append(LegislationVote(self.file_number, matching_legislator.member_id, vote_type))
-            
+                continue
+
+            vote_type = HTML_VOTE_TYPES.get(vote, -1)
+            if vote_type == -1:
+                logging.warning('Could not find how ' + matching_legislator.full_name() + ' voted (' + vote + ') on ' + self.file_number)
+            logging.debug('Adding legislation vote of ' + str(vote_type) + ' from ' + str(matching_legislator.full_name()) + ' on ' + self.file_number)
+            votes.append(LegislationVote(self.file_number, matching_legislator.member_id, vote_type))
+
         logging.debug('Parsed ' + str(len(votes)) + ' votes from html on ' + self.file_number)
         return votes
 
     def parse_from_pdf(self, raw_text):
-        keywords = ['AYES', 'NOES', 'ABSENT', 'ABSTENTION', 'EXCUSED', 'ATTEST']
-        last_keywords = [raw_text.rfind(k) for k in keywords]
+        with metrics.timed('vote_parse_seconds', source='pdf'):
+            votes = self.parse_pdf_votes(raw_text)
+        metrics.increment('votes_parsed_total', len(votes), source='pdf')
+        return votes
+
+    def parse_pdf_votes(self, raw_text):
+        sections = PDFVoteSections(raw_text)
+        name_positions = pdfNamePattern(self.legislators).positions(raw_text)
 
         votes = []
         for legislator in self.legislators:
-            try:
-                name_index = raw_text.rindex(legislator.last_name)
-                min_index = min(range(len(last_keywords)), key = lambda i: name_index - last_keywords[i] if last_keywords[i] != -1 and name_index >= last_keywords[i] else 999999 - i)
-                if min_index >= len(keywords) - 1:
-                    raise ValueError("Last occurence of " + legislator.full_name() + " appeared before all of the voting keywords.")
-                vote_type = min_index + 1
-                logging.debug('Adding legislation vote of ' + str(vote_type) + ' from ' + legislator.full_name() + ' on ' + self.file_number)
-                votes.append(LegislationVote(self.file_number, legislator.member_id, vote_type))
-            except ValueError:
+            mentions = [sections.vote_type_at(p) for p in name_positions.get(legislator.last_name, [])]
+            counted = [v for v in mentions if v != None]
+            if len(counted) == 0:
                 logging.warning('Could not find how ' + legislator.full_name() + ' voted on ' + self.file_number)
-                votes.append(LegislationVote(self.file_number, legislator.member_id, -1))
+                votes.append(LegislationVote(self.file_number, legislator.member_id, -1, 0.0))
+                continue
 
-        logging.debug('Parsed ' + str(len(votes)) + ' votes from html on ' + self.file_number)
+            # The last mention inside the vote block wins, a later one outside it (eg a
+            # signature after ATTEST) or a mention under several keywords lowers confidence
+            vote_type = counted[-1]
+            confidence = 1.0
+            if mentions[-1] == None:
+                confidence -= 0.25
+            if len(set(counted)) > 1:
+                confidence -= 0.5
+                logging.warning(legislator.full_name() + ' appears under several voting keywords on ' + self.file_number + ', using the last')
+            logging.debug('Adding legislation vote of ' + str(vote_type) + ' from ' + legislator.full_name() + ' on ' + self.file_number + ' with confidence ' + str(confidence))
+            votes.append(LegislationVote(self.file_number, legislator.member_id, vote_type, confidence))
+
+        logging.debug('Parsed ' + str(len(votes)) + ' votes from pdf on ' + self.file_number)
         return votes
 
 def fetchPDF(url):
     logging.info('Requesting PDF from ' + url)
-    request = requests.get(url)
+    request = fetch_client.sharedClient().get(url)
     logging.info("Success!")
     return request.content
 
 def loadPDF(file_number, url, store_locally=False):
-    filename = file_number + ".pdf"
-    logging.debug('Loading PDF with local storage file ' + filename)
-    try:
-        f = open(filename, 'rb')
-        content = f.read()
-        f.close()
-        logging.debug('Loaded from local storage')
-        return content
-    except IOError:
-        logging.debug('Local storage file not found')
-        content = fetchPDF(url)
-        if not store_locally:
-            return content
-        f = open(filename, 'wb')
-        f.write(content)
-        f.close()
-        return content
+    key = file_number + ".pdf"
+    logging.debug('Loading PDF with cache key ' + key)
+    content, encoding = download_cache.sharedCache().load(key, url, store_locally)
+    return content
+
+def pdfTextVersion():
+    # pdfminer is only imported by runs that handle PDFs, it is most of record_votes' import time
+    import pdfminer
+    return PDF_TEXT_VERSION + '/' + pdfminer.__version__
 
 def extractText(pdf_contents):
+    from pdfminer.high_level import extract_text
     pdf_file = BytesIO(pdf_contents)
     text = extract_text(pdf_file)
     pdf_file.close()
     return text
 
+def countPages(pdf_file):
+    from pdfminer.pdfdocument import PDFDocument
+    from pdfminer.pdfpage import PDFPage
+    from pdfminer.pdfparser import PDFParser
+    from pdfminer.pdftypes import resolve1
+    document = PDFDocument(PDFParser(pdf_file))
+    try:
+        return int(resolve1(resolve1(document.catalog['Pages'])['Count']))
+    except Exception:
+        return sum(1 for page in PDFPage.create_pages(document))
+
+def extractVoteText(pdf_contents, trailing_pages=DEFAULT_TRAILING_PAGES):
+    # Lays out the last trailing_pages pages first, doubling the range towards the
+    # start of the document until the vote block is found. Pages are extracted once
+    # each and prepended, which matches extracting the combined range in one go.
+    # Returns the text and the number of pages that were laid out.
+    with metrics.timed('pdf_extract_seconds'):
+        text, pages_parsed = extractVoteTextPages(pdf_contents, trailing_pages)
+    if pages_parsed != None:
+        metrics.increment('pdf_pages_extracted_total', pages_parsed)
+    return text, pages_parsed
+
+def extractVoteTextPages(pdf_contents, trailing_pages):
+    from pdfminer.high_level import extract_text
+    if trailing_pages == None or trailing_pages <= 0:
+        return extractText(pdf_contents), None
+
+    pdf_file = BytesIO(pdf_contents)
+    page_count = countPages(pdf_file)
+    text = ''
+    last_page = page_count
+    window = trailing_pages
+    while last_page > 0:
+        first_page = max(0, page_count - window)
+        pdf_file.seek(0)
+        text = extract_text(pdf_file, page_numbers=set(range(first_page, last_page))) + text
+        last_page = first_page
+        if PDF_KEYWORDS[0] in text:
+            break
+        window *= 2
+    pdf_file.close()
+
+    pages_parsed = page_count - last_page
+    logging.debug('Extracted ' + str(pages_parsed) + ' of ' + str(page_count) + ' PDF pages')
+    return text, pages_parsed
+
+class ExtractionTimeout(BaseException):
+    # Not an Exception, so an except Exception inside pdfminer can't swallow it
+    pass
+
+# Seconds between repeated alarms once an extraction has run past its timeout
+EXTRACTION_TIMEOUT_INTERVAL = 1.0
+
+def raiseExtractionTimeout(signum, frame):
+    raise ExtractionTimeout()
+
+def extractTextWithTimeout(pdf_contents, timeout=DEFAULT_PDF_TIMEOUT, trailing_pages=DEFAULT_TRAILING_PAGES):
+    # Returns None if extraction takes longer than timeout seconds. Relies on SIGALRM,
+    # which only a process's main thread can handle, and is unbounded anywhere else.
+    use_alarm = timeout != None and hasattr(signal, 'SIGALRM') and threading.current_thread() is threading.main_thread()
+    if use_alarm:
+        previous_handler = signal.signal(signal.SIGALRM, raiseExtractionTimeout)
+        # Fires again every second until disarmed, in case a bare except still catches it
+        signal.setitimer(signal.ITIMER_REAL, timeout, EXTRACTION_TIMEOUT_INTERVAL)
+    try:
+        text, pages_parsed = extractVoteText(pdf_contents, trailing_pages)
+        return text
+    except ExtractionTimeout:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+        metrics.increment('pdf_extract_timeouts_total')
+        return None
+    finally:
+        if use_alarm:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, previous_handler)
+
+def extractMeasuredText(pdf_contents, timeout=DEFAULT_PDF_TIMEOUT, trailing_pages=DEFAULT_TRAILING_PAGES):
+    # Runs in a pool worker and hands its metrics back to be merged by the parent.
+    # Whatever the worker inherited or recorded before this job is dropped first.
+    metrics.drain()
+    try:
+        text = extractTextWithTimeout(pdf_contents, timeout, trailing_pages)
+    except (Exception, ExtractionTimeout) as e:
+        return None, str(e) or type(e).__name__, metrics.drain()
+    return text, None, metrics.drain()
+
+def extractTexts(pdf_jobs, max_workers=DEFAULT_PDF_WORKERS, timeout=DEFAULT_PDF_TIMEOUT, trailing_pages=DEFAULT_TRAILING_PAGES):
+    # Takes (key, pdf_contents) pairs and yields (key, text) as each extraction finishes,
+    # with text None if it failed or timed out. pdf_jobs is consumed lazily so at most
+    # two PDFs per worker are held in memory or queued at once.
+    if max_workers <= 1:
+        for key, pdf_contents in pdf_jobs:
+            try:
+                yield key, extractTextWithTimeout(pdf_contents, timeout, trailing_pages)
+            except Exception as e:
+                logging.warning('PDF text extraction failed for ' + str(key) + ': ' + str(e))
+                yield key, None
+        return
+
+    jobs = iter(pdf_jobs)
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        pending = {}
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < max_workers * 2:
+                try:
+                    key, pdf_contents = next(jobs)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(extractMeasuredText, pdf_contents, timeout, trailing_pages)] = key
+
+            if len(pending) == 0:
+                return
+
+            done, not_done = wait(pending.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                key = pending.pop(future)
+                try:
+                    text, error, worker_metrics = future.result()
+                    metrics.merge(worker_metrics)
+                except Exception as e:
+                    text, error = None, str(e)
+                if error != None:
+                    logging.warning('PDF text extraction failed for ' + str(key) + ': ' + error)
+                yield key, text
+
+def extractCachedTexts(pdf_jobs, max_workers=DEFAULT_PDF_WORKERS, timeout=DEFAULT_PDF_TIMEOUT, trailing_pages=DEFAULT_TRAILING_PAGES):
+    # Same as extractTexts, but PDFs whose text was already extracted skip the pool
+    cache = artifact_cache.sharedCache()
+    context = str(trailing_pages)
+    text_version = pdfTextVersion()
+    content_hashes = {}
+    cached_texts = []
+
+    def uncachedJobs():
+        for key, pdf_contents in pdf_jobs:
+            content_hash = artifact_cache.contentHash(pdf_contents)
+            found, text = cache.get('pdf_text', text_version, content_hash, context)
+            if found:
+                cached_texts.append((key, text))
+                continue
+            content_hashes[key] = content_hash
+            yield key, pdf_contents
+
+    for key, text in extractTexts(uncachedJobs(), max_workers, timeout, trailing_pages):
+        while len(cached_texts) > 0:
+            yield cached_texts.pop(0)
+        # Failures are not cached so they are retried on the next run
+        if text != None:
+            cache.put('pdf_text', text_version, content_hashes.pop(key), text, context)
+        yield key, text
+
+    while len(cached_texts) > 0:
+        yield cached_texts.pop(0)
+
+def extractCachedVoteText(pdf_contents, timeout=DEFAULT_PDF_TIMEOUT, trailing_pages=DEFAULT_TRAILING_PAGES):
+    # Extracts in this process, so the timeout only applies on the main thread
+    for key, text in extractCachedTexts([(None, pdf_contents)], 1, timeout, trailing_pages):
+        return text
+
+def cachedVotes(kind, parser, source_text, parse):
+    cache = artifact_cache.sharedCache()
+    content_hash = artifact_cache.contentHash(source_text)
+    context = parser.cache_context()
+    found, rows = cache.get(kind, VOTES_PARSER_VERSION, content_hash, context)
+    if found:
+        if rows == None:
+            return None
+        return [LegislationVote(parser.file_number, r[0], r[1], r[2]) for r in rows]
+
+    votes = parse()
+    rows = None if votes == None else [[vote.member_id, vote.vote_type, vote.confidence] for vote in votes]
+    cache.put(kind, VOTES_PARSER_VERSION, content_hash, rows, context)
+    return votes
+
+def parseCachedHTMLVotes(parser, html_content):
+    return cachedVotes('html_votes', parser, html_content, lambda: parser.parse_from_html(extractHTMLTree(html_content)))
+
+def parseCachedPDFVotes(parser, pdf_text):
+    return cachedVotes('pdf_votes', parser, pdf_text, lambda: parser.parse_from_pdf(pdf_text))
+
 def fetchHTML(url):
     logging.info('Requesting page source from ' + url)
-    request = requests.get(url)
+    request = fetch_client.sharedClient().get(url)
     logging.info("Success!")
     return request.text
 
 def loadHTML(file_number, url, store_locally=False):
-    filename = file_number + "-votes.html"
-    logging.debug('Loading html with local storage file ' + filename)
-    try:
-        f = open(filename, 'r')
-        text = f.read()
-        f.close()
-        logging.debug('Loaded from local storage')
-        return text
-    except IOError:
-        logging.debug('Local storage file not found')
-        text = fetchHTML(url)
-        if not store_locally:
-            return text
-        f = open(filename, 'w')
-        f.write(text)
-        f.close()
-        return text
+    key = file_number + "-votes.html"
+    logging.debug('Loading html with cache key ' + key)
+    content, encoding = download_cache.sharedCache().load(key, url, store_locally, 'utf-8')
+    return download_cache.decodeText(content, encoding)
 
 def extractHTMLTree(html_content):
     parser = HTMLTreeParser()
@@ -187,37 +533,97 @@ def extractHTMLTree(html_content):
     parser.close()
     return html_tree
 
-def exportVotes(votes):
-    database = VotesDatabase()
-    database.remove_table()
-    database.create_table()
-    database.add_items(votes)
-    database.close()
+def exportVotes(votes, incremental=False):
+    votes_db = VotesDatabase()
+    counts = None
+    if incremental:
+        votes_db.create_table()
+        counts = votes_db.upsert_items(votes)
+        logging.info('Exported legislation votes: ' + str(counts))
+    else:
+        votes_db.remove_table()
+        votes_db.create_table()
+        votes_db.add_items(votes)
+    votes_db.close()
+    return counts
+
+def loadPDFOrNone(details_item):
+    try:
+        return loadPDF(details_item.file_number, details_item.pdf_link, True)
+    except IOError as e:
+        logging.warning('Skipping ' + details_item.file_number + ' because its PDF could not be downloaded: ' + str(e))
+        return None
 
-def main():
+def main(incremental=False, max_workers=DEFAULT_PDF_WORKERS, timeout=DEFAULT_PDF_TIMEOUT, trailing_pages=DEFAULT_TRAILING_PAGES):
     details_db = DetailsDatabase()
     detail_items = details_db.get_items()
     all_votes = []
+    pdf_parsers = {}
+    pdf_items = []
+    ambiguous_parsers = []
     for item in detail_items:
         parser = VoteParser(item)
 
         if item.action_details_link != None:
-            html_content = loadHTML(item.file_number, item.action_details_link, True)
-            html_tree = extractHTMLTree(html_content)
-            html_votes = parser.parse_from_html(html_tree)
+            try:
+                html_content = loadHTML(item.file_number, item.action_details_link, True)
+            except IOError as e:
+                # Falls back to the PDF, as when the page has no votes
+                logging.warning('Could not load action details for ' + item.file_number + ': ' + str(e))
+                html_content = None
+            html_votes = parseCachedHTMLVotes(parser, html_content) if html_content != None else None
+            if len(parser.ambiguities) > 0:
+                ambiguous_parsers.append(parser)
             if html_votes != None:
                 all_votes += html_votes
                 continue
 
         if item.pdf_link != None:
-            pdf_content = loadPDF(item.file_number, item.pdf_link, True)
-            pdf_text = extractText(pdf_content)
-            all_votes += parser.parse_from_pdf(pdf_text)
+            pdf_parsers[item.file_number] = parser
+            pdf_items.append(item)
         else:
             logging.warning('Skipping ' + item.file_number)
-        
-    exportVotes(all_votes)
+
+    # PDFs are downloaded as the extraction pool asks for more work
+    pdf_jobs = ((item.file_number, content) for item, content in ((item, loadPDFOrNone(item)) for item in pdf_items) if content != None)
+    for file_number, pdf_text in extractCachedTexts(pdf_jobs, max_workers, timeout, trailing_pages):
+        if pdf_text == None:
+            logging.warning('Skipping ' + file_number + ' because its PDF text could not be extracted')
+            continue
+        all_votes += parseCachedPDFVotes(pdf_parsers[file_number], pdf_text)
+
+    # Only rows parsed in this run, votes served from the artifact cache were reported when first parsed
+    for parser in ambiguous_parsers:
+        logging.warning('Skipped ' + str(len(parser.ambiguities)) + ' ambiguous votes on ' + parser.file_number + ': ' + ', '.join([name for name, candidates in parser.ambiguities]))
+
+    exportVotes(all_votes, incremental)
 
 if __name__ == "__main__": 
-    main() 
+    parser = logging_setup.argumentParser()
+    parser.add_argument(
+        '-i', '--incremental',
+        help="Only write new or changed votes instead of rebuilding the table",
+        action="store_true", dest="incremental",
+        default=False,
+    )
+    parser.add_argument(
+        '--pdf-workers',
+        help="Number of processes extracting PDF text (1 to extract in this process)",
+        type=int, dest="max_workers",
+        default=DEFAULT_PDF_WORKERS,
+    )
+    parser.add_argument(
+        '--pdf-timeout',
+        help="Seconds a single PDF may take to extract before it is skipped",
+        type=float, dest="timeout",
+        default=DEFAULT_PDF_TIMEOUT,
+    )
+    parser.add_argument(
+        '--trailing-pages',
+        help="Number of trailing PDF pages to search for votes before widening (0 for the whole document)",
+        type=int, dest="trailing_pages",
+        default=DEFAULT_TRAILING_PAGES,
+    )
+    args, unused = parser.parse_known_args()
+    main(args.incremental, args.max_workers, args.timeout, args.trailing_pages)
 
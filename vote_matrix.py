@@ -0,0 +1,212 @@
+import council_members
+import database
+from legislation import LegislationDatabase
+from legislation import LegislationItem
+from legislation_details import DetailsDatabase
+import logging_setup
+from logging_setup import logging
+from record_votes import VotesDatabase
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Vote types from record_votes, 0 in the matrix means no recorded vote
+AYE = 1
+NO = 2
+ABSENT = 3
+ABSTAINED = 4
+EXCUSED = 5
+# Votes that show the member was in the room
+PRESENT_TYPES = [AYE, NO, ABSTAINED]
+DEFAULT_BLOC_THRESHOLD = 0.8
+
+def requireNumpy():
+    if numpy == None:
+        raise ImportError('vote_matrix needs numpy, install it with pip3 install numpy')
+
+def categoryIndex(category):
+    # Accepts a name from LegislationItem.CATEGORY_TYPES or the stored 1-based index
+    if isinstance(category, int):
+        return category
+    return LegislationItem.CATEGORY_TYPES.index(category) + 1
+
+class VoteMatrix:
+    # values[i, j] is the vote_type of member_ids[i] on file_numbers[j]. Every array
+    # is a plain dtype, so saved matrices load with mmap_mode and without pickle.
+    def __init__(self, values, member_ids, file_numbers):
+        self.values = values
+        self.member_ids = member_ids
+        self.file_numbers = file_numbers
+
+    def save(self, prefix):
+        requireNumpy()
+        numpy.save(prefix + '.values.npy', self.values)
+        numpy.save(prefix + '.members.npy', self.member_ids)
+        numpy.save(prefix + '.items.npy', self.file_numbers)
+
+    @staticmethod
+    def load(prefix, mmap=True):
+        requireNumpy()
+        mmap_mode = 'r' if mmap else None
+        return VoteMatrix(
+            numpy.load(prefix + '.values.npy', mmap_mode=mmap_mode),
+            numpy.load(prefix + '.members.npy'),
+            numpy.load(prefix + '.items.npy'),
+        )
+
+def selectedItems(start_date=None, end_date=None, categories=None):
+    # File numbers whose final action falls in [start_date, end_date] and whose
+    # category is one of categories, or None to keep every item
+    connection = database.connection()
+    selected = None
+    if categories != None:
+        # Legislation file numbers are utf8 blobs
+        indexes = [categoryIndex(c) for c in categories]
+        command = "SELECT CAST(file_number AS TEXT) FROM " + LegislationDatabase.TABLE_NAME + " WHERE category IN (" + ','.join(['?' for i in indexes]) + ");"
+        selected = {r[0] for r in connection.execute(command, indexes).fetchall()}
+
+    if start_date != None or end_date != None:
+        start_date = council_members.parseDate(start_date) if start_date != None else None
+        end_date = council_members.parseDate(end_date) if end_date != None else None
+        in_range = set()
+        command = "SELECT file_number, action_date FROM " + DetailsDatabase.TABLE_NAME + " WHERE action_date IS NOT NULL;"
+        for file_number, action_date in connection.execute(command).fetchall():
+            date = council_members.parseDate(action_date)
+            if (start_date == None or date >= start_date) and (end_date == None or date <= end_date):
+                in_range.add(file_number)
+        selected = in_range if selected == None else selected & in_range
+    return selected
+
+def voteRows(start_date=None, end_date=None, categories=None):
+    # (file_number, member_id, vote_type) for votes on the selected items. Filters are
+    # applied to the few thousand items rather than joined against every vote.
+    selected = selectedItems(start_date, end_date, categories)
+    # Placeholder votes from member -1 are not a member's record
+    command = "SELECT file_number, member_id, vote_type FROM " + VotesDatabase.TABLE_NAME + " WHERE member_id >= 0;"
+    rows = database.connection().execute(command).fetchall()
+    if selected == None:
+        return rows
+    return [r for r in rows if r[0] in selected]
+
+def loadMatrix(start_date=None, end_date=None, categories=None):
+    requireNumpy()
+    rows = voteRows(start_date, end_date, categories)
+    logging.debug('Building vote matrix from ' + str(len(rows)) + ' votes')
+    if len(rows) == 0:
+        return VoteMatrix(numpy.zeros((0, 0), dtype=numpy.int8), numpy.zeros(0, dtype=numpy.int64), numpy.zeros(0, dtype='U1'))
+
+    file_numbers, member_ids, vote_types = zip(*rows)
+    item_keys, item_positions = numpy.unique(numpy.array(file_numbers, dtype=str), return_inverse=True)
+    member_keys, member_positions = numpy.unique(numpy.array(member_ids, dtype=numpy.int64), return_inverse=True)
+    values = numpy.zeros((len(member_keys), len(item_keys)), dtype=numpy.int8)
+    values[member_positions, item_positions] = numpy.array(vote_types, dtype=numpy.int8)
+    return VoteMatrix(values, member_keys, item_keys)
+
+def participation(matrix):
+    # Per member, the share of items with a recorded vote where they were present
+    # -1 is a vote record_votes could not read, which says nothing about attendance
+    recorded = (matrix.values > 0).sum(axis=1)
+    present = numpy.isin(matrix.values, PRESENT_TYPES).sum(axis=1)
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return present / recorded
+
+def agreement(matrix):
+    # [i, j] is the share of items both members voted aye or no on where they voted
+    # the same way, nan for pairs that never did
+    ayes = (matrix.values == AYE).astype(numpy.float32)
+    noes = (matrix.values == NO).astype(numpy.float32)
+    decided = ayes + noes
+    same = ayes @ ayes.T + noes @ noes.T
+    both = decided @ decided.T
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return same / both
+
+def similarity(matrix):
+    # Cosine similarity of members' voting records with aye as 1 and no as -1, which
+    # discounts the unanimous items that dominate agreement
+    record = (matrix.values == AYE).astype(numpy.float32) - (matrix.values == NO).astype(numpy.float32)
+    norms = numpy.sqrt((record * record).sum(axis=1))
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        return (record @ record.T) / numpy.outer(norms, norms)
+
+def blocs(matrix, similarities=None, threshold=DEFAULT_BLOC_THRESHOLD):
+    # Groups of member_ids joined by any pairwise similarity at or above threshold
+    if similarities is None:
+        similarities = similarity(matrix)
+    linked = numpy.nan_to_num(similarities) >= threshold
+    unvisited = set(range(len(matrix.member_ids)))
+    groups = []
+    while len(unvisited) > 0:
+        stack = [unvisited.pop()]
+        group = []
+        while len(stack) > 0:
+            i = stack.pop()
+            group.append(int(matrix.member_ids[i]))
+            for j in numpy.flatnonzero(linked[i]):
+                if j in unvisited:
+                    unvisited.remove(j)
+                    stack.append(j)
+        groups.append(sorted(group))
+    return sorted(groups, key = lambda g: (-len(g), g))
+
+def printMatrix(title, matrix, values, names):
+    print(title)
+    labels = [names.get(int(m), str(m)) for m in matrix.member_ids]
+    for label, row in zip(labels, values):
+        print(label.ljust(28) + ' '.join(['  -  ' if numpy.isnan(v) else '{0:5.2f}'.format(v) for v in row]))
+
+def main(start_date=None, end_date=None, categories=None, save_prefix=None, threshold=DEFAULT_BLOC_THRESHOLD):
+    matrix = loadMatrix(start_date, end_date, categories)
+    logging.info('Loaded votes of ' + str(len(matrix.member_ids)) + ' members on ' + str(len(matrix.file_numbers)) + ' items')
+    if save_prefix != None:
+        matrix.save(save_prefix)
+
+    legislator_db = council_members.LegislatorDatabase()
+    names = {l.member_id: l.full_name() for l in legislator_db.get_members()}
+    legislator_db.close()
+
+    printMatrix('Participation', matrix, participation(matrix)[:, None], names)
+    printMatrix('Agreement', matrix, agreement(matrix), names)
+    similarities = similarity(matrix)
+    printMatrix('Similarity', matrix, similarities, names)
+    print('Blocs')
+    for group in blocs(matrix, similarities, threshold):
+        print(', '.join([names.get(m, str(m)) for m in group]))
+
+if __name__ == "__main__":
+    parser = logging_setup.argumentParser()
+    parser.add_argument(
+        '--start',
+        help="Only include items with a final action on or after this date (YYYY-MM-DD)",
+        dest="start_date",
+        default=None,
+    )
+    parser.add_argument(
+        '--end',
+        help="Only include items with a final action on or before this date (YYYY-MM-DD)",
+        dest="end_date",
+        default=None,
+    )
+    parser.add_argument(
+        '--category',
+        help="Only include items of these categories, eg Ordinance",
+        nargs='+', dest="categories",
+        choices=LegislationItem.CATEGORY_TYPES,
+        default=None,
+    )
+    parser.add_argument(
+        '--save',
+        help="Save the matrix as <prefix>.values.npy, <prefix>.members.npy and <prefix>.items.npy",
+        dest="save_prefix",
+        default=None,
+    )
+    parser.add_argument(
+        '--bloc-threshold',
+        help="Similarity at which two members are counted in the same bloc",
+        type=float, dest="threshold",
+        default=DEFAULT_BLOC_THRESHOLD,
+    )
+    args, unused = parser.parse_known_args()
+    main(args.start_date, args.end_date, args.categories, args.save_prefix, args.threshold)
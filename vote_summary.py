@@ -0,0 +1,170 @@
+from contextlib import contextmanager
+import database
+from legislation_details import DetailsDatabase
+import logging_setup
+from logging_setup import logging
+import sys
+
+# Same name as VotesDatabase.TABLE_NAME, which can't be imported here since
+# record_votes imports this module
+VOTES_TABLE_NAME = 'legislation_votes'
+MEMBER_TABLE_NAME = 'member_vote_summary'
+ITEM_TABLE_NAME = 'item_vote_tally'
+# Vote types 1 to 5, in the order of record_votes.PDF_KEYWORDS
+TALLY_COLUMNS = ['ayes', 'noes', 'absent', 'abstained', 'excused']
+# Year of the item's final action, 0 when the item has no details or action date.
+# Action dates are M/D/YYYY from Legistar, ISO dates are handled too.
+VOTE_YEAR = """COALESCE(CASE WHEN d.action_date LIKE '%/%/%' THEN CAST(substr(d.action_date, -4) AS INTEGER)
+    ELSE CAST(substr(d.action_date, 1, 4) AS INTEGER) END, 0)"""
+VOTES_WITH_YEAR = VOTES_TABLE_NAME + " v LEFT JOIN " + DetailsDatabase.TABLE_NAME + " d ON d.file_number = v.file_number"
+MEMBER_COUNTS = "SELECT v.member_id, " + VOTE_YEAR + " AS year, v.vote_type, COUNT(*) FROM " + VOTES_WITH_YEAR
+ITEM_TALLIES = ("SELECT v.file_number, "
+    + ', '.join(["SUM(v.vote_type = " + str(i + 1) + ")" for i in range(len(TALLY_COLUMNS))])
+    + ", SUM(v.vote_type NOT BETWEEN 1 AND " + str(len(TALLY_COLUMNS)) + "), COUNT(*) FROM " + VOTES_TABLE_NAME + " v")
+
+class VoteSummaryDatabase:
+    # Per-member vote counts by year and per-item tallies, kept in step with every
+    # write to the votes table so pages can read them by primary key
+    def __init__(self):
+        self.connection = database.connection()
+        self.cursor = self.connection.cursor()
+
+    def remove_table(self):
+        logging.debug('Dropping vote summary tables')
+        self.cursor.execute("DROP TABLE IF EXISTS " + MEMBER_TABLE_NAME + ";")
+        self.cursor.execute("DROP TABLE IF EXISTS " + ITEM_TABLE_NAME + ";")
+
+    def create_table(self):
+        logging.debug('Creating vote summary tables')
+        # Years come from the details table, which may not exist yet, eg in a new database
+        details_db = DetailsDatabase()
+        details_db.create_table()
+        existed = self.table_exists(MEMBER_TABLE_NAME)
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS " + MEMBER_TABLE_NAME + """ (
+member_id INTEGER NOT NULL,
+year INTEGER NOT NULL,
+vote_type INTEGER NOT NULL,
+count INTEGER NOT NULL,
+PRIMARY KEY (member_id, year, vote_type)
+) WITHOUT ROWID;""")
+        self.cursor.execute("CREATE TABLE IF NOT EXISTS " + ITEM_TABLE_NAME + """ (
+file_number TEXT NOT NULL PRIMARY KEY,
+""" + ''.join([column + " INTEGER NOT NULL,\n" for column in TALLY_COLUMNS]) + """other INTEGER NOT NULL,
+total INTEGER NOT NULL
+) WITHOUT ROWID;""")
+        # Databases with votes from before the summaries existed start from a full count
+        if not existed and self.table_exists(VOTES_TABLE_NAME):
+            self.rebuild()
+
+    def table_exists(self, table_name):
+        return self.cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?;", (table_name,)).fetchone() != None
+
+    def is_available(self):
+        # False until the votes and summary tables exist, eg while only details are loaded
+        return self.table_exists(MEMBER_TABLE_NAME) and self.table_exists(VOTES_TABLE_NAME)
+
+    def member_counts(self, file_numbers):
+        # (member_id, year, vote_type) -> count over the votes on file_numbers
+        counts = {}
+        for file_number_chunk in database.chunks(file_numbers):
+            command = MEMBER_COUNTS + " WHERE v.file_number IN (" + ','.join(['?' for f in file_number_chunk]) + ") GROUP BY 1, 2, 3;"
+            for member_id, year, vote_type, count in self.cursor.execute(command, file_number_chunk).fetchall():
+                key = (member_id, year, vote_type)
+                counts[key] = counts.get(key, 0) + count
+        return counts
+
+    def apply_member_deltas(self, before, after):
+        deltas = []
+        for key in set(before.keys()) | set(after.keys()):
+            delta = after.get(key, 0) - before.get(key, 0)
+            if delta != 0:
+                deltas.append(key + (delta,))
+        if len(deltas) == 0:
+            return
+        command = "INSERT INTO " + MEMBER_TABLE_NAME + """ (member_id, year, vote_type, count) VALUES (?, ?, ?, ?)
+ON CONFLICT (member_id, year, vote_type) DO UPDATE SET count = count + excluded.count;"""
+        self.cursor.executemany(command, deltas)
+        self.cursor.execute("DELETE FROM " + MEMBER_TABLE_NAME + " WHERE count = 0;")
+
+    def refresh_tallies(self, file_numbers):
+        for file_number_chunk in database.chunks(file_numbers):
+            placeholders = ','.join(['?' for f in file_number_chunk])
+            self.cursor.execute("DELETE FROM " + ITEM_TABLE_NAME + " WHERE file_number IN (" + placeholders + ");", file_number_chunk)
+            self.cursor.execute("INSERT INTO " + ITEM_TABLE_NAME + " " + ITEM_TALLIES + " WHERE v.file_number IN (" + placeholders + ") GROUP BY v.file_number;", file_number_chunk)
+
+    @contextmanager
+    def tracking(self, file_numbers):
+        # Wraps a write to the votes or details on file_numbers. The summaries change
+        # by the difference between those votes before and after, so replaced and
+        # deleted votes and changed action dates are accounted for without a full recount.
+        file_numbers = list(set(file_numbers))
+        with database.transaction():
+            before = self.member_counts(file_numbers)
+            yield
+            self.apply_member_deltas(before, self.member_counts(file_numbers))
+            self.refresh_tallies(file_numbers)
+
+    def rebuild(self):
+        logging.info('Rebuilding vote summary tables')
+        with database.transaction():
+            self.cursor.execute("DELETE FROM " + MEMBER_TABLE_NAME + ";")
+            self.cursor.execute("DELETE FROM " + ITEM_TABLE_NAME + ";")
+            self.cursor.execute("INSERT INTO " + MEMBER_TABLE_NAME + " (member_id, year, vote_type, count) " + MEMBER_COUNTS + " GROUP BY 1, 2, 3;")
+            self.cursor.execute("INSERT INTO " + ITEM_TABLE_NAME + " " + ITEM_TALLIES + " GROUP BY v.file_number;")
+
+    def check(self):
+        # Rows that differ between the stored summaries and a full recount, in
+        # either direction. Drift can come from writes that bypass VotesDatabase and
+        # DetailsDatabase, eg a manual edit of the database.
+        comparisons = [
+            (MEMBER_TABLE_NAME, "SELECT member_id, year, vote_type, count FROM " + MEMBER_TABLE_NAME, MEMBER_COUNTS + " GROUP BY 1, 2, 3"),
+            (ITEM_TABLE_NAME, "SELECT * FROM " + ITEM_TABLE_NAME, ITEM_TALLIES + " GROUP BY v.file_number"),
+        ]
+        differences = {}
+        for table_name, stored, recounted in comparisons:
+            command = "SELECT COUNT(*) FROM (" + stored + " EXCEPT " + recounted + ") UNION ALL SELECT COUNT(*) FROM (" + recounted + " EXCEPT " + stored + ");"
+            extra, missing = [r[0] for r in self.cursor.execute(command).fetchall()]
+            differences[table_name] = extra + missing
+        return differences
+
+    def get_member_summary(self, member_id):
+        # [(year, vote_type, count)] by year
+        command = "SELECT year, vote_type, count FROM " + MEMBER_TABLE_NAME + " WHERE member_id = ? ORDER BY year, vote_type;"
+        return [tuple(r) for r in self.cursor.execute(command, (member_id,)).fetchall()]
+
+    def get_item_tally(self, file_number):
+        # {column: count} or None if the item has no votes
+        command = "SELECT " + ', '.join(TALLY_COLUMNS) + ", other, total FROM " + ITEM_TABLE_NAME + " WHERE file_number = ?;"
+        r = self.cursor.execute(command, (file_number,)).fetchone()
+        if r == None:
+            return None
+        return dict(zip(TALLY_COLUMNS + ['other', 'total'], r))
+
+    def close(self):
+        logging.debug('Closed connection to vote summary tables')
+        database.commit()
+
+def main(rebuild=False):
+    summary_db = VoteSummaryDatabase()
+    summary_db.create_table()
+    if rebuild:
+        summary_db.rebuild()
+    differences = summary_db.check()
+    summary_db.close()
+    for table_name, count in differences.items():
+        if count > 0:
+            logging.error(table_name + ' has ' + str(count) + ' rows that differ from the votes table, run with --rebuild to recompute it')
+        else:
+            logging.info(table_name + ' matches the votes table')
+    return 1 if any([count > 0 for count in differences.values()]) else 0
+
+if __name__ == "__main__":
+    parser = logging_setup.argumentParser()
+    parser.add_argument(
+        '--rebuild',
+        help="Recompute the summary tables from the votes table before checking them",
+        action="store_true", dest="rebuild",
+        default=False,
+    )
+    args, unused = parser.parse_known_args()
+    sys.exit(main(args.rebuild))